@@ -1,7 +1,9 @@
 import constants
 from points import Point
 from routes import create_route, Route
-from general_maths import calculate_distance
+from general_maths import calculate_distance, check_if_point_in_polygons
+from geography import polygons_near_point
+from distance_fields import get_distance_field
 import copy
 
 import numpy as np
@@ -94,15 +96,16 @@ class Agent:
         self.marker = None
         self.text = None
 
-    def generate_route(self, destination: Point = None) -> None:
+    def generate_route(self, destination: Point = None, use_cache: bool = True) -> None:
         """
         Creates a route from current location to a certain point, while avoiding the default list of obstacles
         provided for the agent
         :param destination: Reachable location for the agent
+        :param use_cache: Whether the route may come from the route cache
         :return:
         """
-        self.route = create_route(point_a=self.location, point_b=destination,
-                                  polygons_to_avoid=copy.deepcopy(self.obstacles))
+        self.route = create_route(point_a=self.location, point_b=destination, polygons_to_avoid=self.obstacles,
+                                  use_cache=use_cache)
         self.past_points.append(self.route.points[0])
         self.last_location = self.location
         self.next_point = self.route.points[1]
@@ -118,18 +121,14 @@ class Agent:
 
     def in_zone(self, name: str):
         """
-        Check if the agent is in a defined zone
+        Check if the agent is in a defined zone - looked up in the zone raster, only exact near the zone edges
         :param name: Name of the zone
         :return:
         """
-        for zone in constants.world.zones:
-            if zone.name == name:
-                if zone.check_if_contains_point(self.location):
-                    return True
-                else:
-                    return False
+        if name not in constants.world.zone_indices:
+            raise NotImplementedError(f"Zone {name} does not exist in {constants.world.zones}")
 
-        raise NotImplementedError(f"Zone {name} does not exist in {constants.world.zones}")
+        return constants.world.zone_raster.polygon_contains_point(constants.world.zone_indices[name], self.location)
 
     def update_trail_route(self) -> None:
         """
@@ -143,12 +142,11 @@ class Agent:
                 self.stop_trailing("Target Reached Destination")
                 return
 
-            for polygon in self.obstacles:
-                if polygon.check_if_contains_point(self.located_agent.location):
-                    logger.debug(
-                        f"Agent {self} is forced to stop chasing {self.located_agent} - in safe zone.")
-                    self.stop_trailing("Target Entered Safe Zone")
-                    return
+            if check_if_point_in_polygons(self.obstacles, self.located_agent.location):
+                logger.debug(
+                    f"Agent {self} is forced to stop chasing {self.located_agent} - in safe zone.")
+                self.stop_trailing("Target Entered Safe Zone")
+                return
 
         self.generate_route(destination=self.located_agent.location)
         if constants.DEBUG_MODE:
@@ -301,13 +299,34 @@ class Agent:
         if required_endurance_max < remaining_endurance:
             return True
 
-        base_route = create_route(self.location, self.base.location, self.obstacles)
+        # The distance field approximates the shortest route to base, which routes home (planned without the route
+        # cache) follow with the visibility graph planner. It can come out slightly shorter, so it is only trusted with
+        # a margin, otherwise the route is created. The convex hull planner can create longer routes, always checked.
+        if constants.ROUTE_PLANNER == "visibility_graph":
+            distance_to_base = self.distance_to_base() * (1 + constants.DISTANCE_FIELD_MARGIN)
+            time_required_to_return = np.ceil(distance_to_base / self.speed)
+            if remaining_endurance * (1 + constants.SAFETY_ENDURANCE) > time_required_to_return:
+                return True
+
+        base_route = create_route(self.location, self.base.location, self.obstacles, use_cache=False)
         time_required_to_return = np.ceil(base_route.length / self.speed)
         if remaining_endurance * (1 + constants.SAFETY_ENDURANCE) <= time_required_to_return:
             self.return_to_base()
         else:
             return True
 
+    def distance_to_base(self, location: Point = None) -> float:
+        """
+        Look up the sea distance from a location (default: the current location) to base in the base's distance field.
+        An approximation of the shortest route to base, that can be up to DISTANCE_FIELD_MARGIN shorter than the route
+        the visibility graph planner creates (without the route cache). Infinite if the field can not tell.
+        :param location: Location to measure from
+        :return: Distance in km
+        """
+        if location is None:
+            location = self.location
+        return get_distance_field(self.base.location, self.obstacles).distance_from(location)
+
     def is_near(self, location: Point = None, agent=None) -> bool:
         """
         See if a location or agent is close to this object
@@ -369,7 +388,15 @@ class Agent:
 
         # logger.debug(f"Checking if UAV {self.uav_id} can reach {target} and return to {self.base.location}")
         path_to_point = create_route(self.location, target, polygons_to_avoid=self.obstacles)
-        path_to_base = create_route(target, self.base.location, polygons_to_avoid=self.obstacles)
+
+        # Same margin on the distance field as in can_continue, only for the visibility graph planner
+        if constants.ROUTE_PLANNER == "visibility_graph":
+            distance_to_base = self.distance_to_base(target) * (1 + constants.DISTANCE_FIELD_MARGIN)
+            endurance_required = (path_to_point.length + distance_to_base) / self.speed
+            if endurance_required * (1 + constants.SAFETY_ENDURANCE) < remaining_endurance:
+                return True
+
+        path_to_base = create_route(target, self.base.location, polygons_to_avoid=self.obstacles, use_cache=False)
         total_length = path_to_point.length + path_to_base.length
         endurance_required = total_length / self.speed
         # See if we have enough endurance remaining, plus small penalty to ensure we can trail
@@ -441,13 +468,11 @@ class Agent:
             raise ValueError(f"Unexpected direction {self.direction}")
 
         left_point = self.move_towards_orientation(distance_to_travel, direction=left_direction)
-        CoP_left, left_receptors = constants.world.receptor_grid.calculate_CoP(left_point, self.radius)
-
         straight_point = self.move_towards_orientation(distance_to_travel, direction=self.direction)
-        CoP_straight, straight_receptors = constants.world.receptor_grid.calculate_CoP(straight_point, self.radius)
-
         right_point = self.move_towards_orientation(distance_to_travel, direction=right_direction)
-        CoP_right, right_receptors = constants.world.receptor_grid.calculate_CoP(right_point, self.radius)
+
+        CoP_left, CoP_straight, CoP_right = constants.world.receptor_grid.calculate_CoP_batch(
+            [left_point, straight_point, right_point], self.radius).tolist()
 
         # logger.debug(f"{CoP_left=}, {CoP_straight=}, {CoP_right=}")
         concentration_of_pheromones = [CoP_left, CoP_straight, CoP_right]
@@ -510,28 +535,18 @@ class Agent:
 
     def spread_pheromones(self):
         """
-        Make the agent spread pheromones surrounding their area
+        Make the agent spread pheromones surrounding their area.
+        The deposits along the path are queued on the receptor grid and applied together with those of the
+        other agents.
         :return:
         """
-        locations = []
-        for lamb in np.arange(0, 1, 1 / constants.world.splits_per_step):
-            x_loc = self.location.x * lamb + self.last_location.x * (1 - lamb)
-            y_loc = self.location.y * lamb + self.last_location.y * (1 - lamb)
-            locations.append(Point(x_loc, y_loc))
-
-        for location in locations:
-            receptors = constants.world.receptor_grid.select_receptors_in_radius(
-                location, radius=self.radius * constants.LATITUDE_CONVERSION_FACTOR)
-
-            for receptor in receptors:
-                if receptor.decay:  # To Check if receptor is not a boundary point
-                    if self.pheromone_type == "alpha":
-                        receptor.alpha_pheromones += ((1 / max(location.distance_to_point(receptor.location), 0.1)) *
-                                                      (self.pheromone_spread / constants.world.splits_per_step))
-                    elif self.pheromone_type == "beta":
-                        receptor.beta_pheromones += ((1 / max(location.distance_to_point(receptor.location), 0.1)) *
-                                                     (self.pheromone_spread / constants.world.splits_per_step))
-                    # receptor.update_plot(self.world.ax, self.world.receptor_grid.cmap)
+        lamb = np.arange(0, 1, 1 / constants.world.splits_per_step)
+        x_loc = self.location.x * lamb + self.last_location.x * (1 - lamb)
+        y_loc = self.location.y * lamb + self.last_location.y * (1 - lamb)
+
+        constants.world.receptor_grid.queue_deposits(
+            x_loc, y_loc, radius=self.radius * constants.LATITUDE_CONVERSION_FACTOR,
+            amount=self.pheromone_spread / constants.world.splits_per_step, pheromone_type=self.pheromone_type)
 
     def engage_agent(self):
         """
@@ -615,7 +630,7 @@ class Agent:
         Checks if any rules and/or logic are violated
         :return:
         """
-        for polygon in self.obstacles:
+        for polygon in polygons_near_point(self.obstacles, self.location):
             if polygon.check_if_contains_point(P=self.location, exclude_edges=True):
                 self.location.add_point_to_plot(axes=constants.axes_plot, color="yellow")
                 if self.last_location is not None:
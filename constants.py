@@ -25,6 +25,22 @@ time_spent_selecting_receptors = 0
 # ---- World Constants ----
 world = None
 WEATHER_RESAMPLING_TIME_SPLIT = 1
+WEATHER_NOISE_FREQUENCY = 8  # Number of noise cells across the grid for the first octave of the sea-state noise
+WEATHER_NOISE_OCTAVES = 1  # Number of octaves summed, each doubles the frequency and halves the amplitude
+WEATHER_NOISE_SEED = None  # Seed of the sea-state noise generator, None for a random seed
+WEATHER_NOISE_PREFETCH = True  # Compute the next noise field on a worker thread in between weather updates
+INITIAL_SEA_STATE = 2  # Common start sea-state of all receptors
+
+WEATHER_MODE = "simulated"  # ["simulated", "timeline", "observed"]
+# simulated: Sample new sea states from the noise field and transition matrix at every weather update [default]
+# timeline: Replay a pre-rendered sea-state timeline, shared by all runs with the same horizon and seed
+# observed: Replay the rounded significant wave heights of the wave data, streamed from disk
+WEATHER_TIMELINE_STEPS = 2000  # Number of weather updates in a rendered timeline
+WEATHER_TIMELINE_SEED = 0  # Seed of the noise generator the timeline is rendered with
+WEATHER_OBSERVED_START = None  # Date in the wave data the simulation starts at (e.g. "2023-01-01"), None for the first
+WEATHER_OBSERVED_CHUNK_SIZE = 48  # Number of time steps of the wave data read at once
+WEATHER_OBSERVED_MAX_DISTANCE = 1  # Maximum distance (in degrees, along either axis) to the nearest data point
+# Receptors farther away (outside the extent of the wave data) are not regridded and keep INITIAL_SEA_STATE
 
 COMMUNICATION_DELAY = 0.5
 
@@ -47,6 +63,20 @@ PLOT_SIZE = 7
 LAT_GRID_EXTRA = 6
 LONG_GRID_EXTRA = 6
 
+RASTER_CELL_SIZE = 0.1  # Cell size (in degrees) of the rasterized polygon masks, should divide GRID_WIDTH
+CACHE_DIRECTORY = "cache"  # Directory the rasters and weather model are cached in, None disables the cache
+
+# ---- Routing ----
+ROUTE_PLANNER = "visibility_graph"  # ["visibility_graph", "convex_hull"]
+# visibility_graph: A* over a visibility graph of the obstacle vertices, built once per set of obstacles [default]
+# convex_hull: Iteratively reroute crossed obstacles along their convex hull
+ROUTE_VISIBILITY_TOLERANCE = 1e-6  # Obstacles are shrunk by this margin so routes can follow the coastline
+ROUTE_CACHE_SIZE = 5000  # Maximum number of routes kept in the route cache, 0 disables the cache
+ROUTE_CACHE_TOLERANCE = 0.05  # Endpoints are snapped to a grid of this size (in degrees) to look up cached routes
+DISTANCE_FIELD_MARGIN = 0.05  # Relative margin on the distance fields to base before their bound is trusted
+# The fields add up short lattice legs, each measured at its own mean latitude, which can come out a few percent
+# (up to ~3.5% over the latitudes of the grid) shorter than the long legs of a planned route over the same ground
+
 # ----- World Rules ------
 
 japan_route = False  # TODO: Force Merchant Route through Japanese territorial waters if True
@@ -87,6 +117,14 @@ japan_engagement = "never_attack"  # ["never_attack",  "attack_territorial", "at
 PHEROMONE_DEPRECIATION_FACTOR_PER_TIME_DELTA = 0.99
 RECEPTOR_RADIUS_MULTIPLIER = 10
 
+COP_MODE = "exact"  # ["exact", "summed_area", "pyramid"]
+# exact: Sum the pheromones of every selected receptor weighted by the inverse distance [default]
+# summed_area: Approximate from summed-area tables of the pheromones, rebuilt by the first query of a time step
+# pyramid: Sum square blocks of receptors, as coarse as the radius allows, from the same summed-area tables
+#          (for fine GRID_WIDTH settings - with blocks of a single receptor, the exact sum is used)
+COP_SUMMED_AREA_RINGS = 4  # Number of rings the summed_area mode divides the selected receptors into
+COP_PYRAMID_CELLS_PER_RADIUS = 3  # Minimum number of pyramid blocks within the radius of a CoP query
+
 # ---- UAV Parameters ----
 UAV_HEALTH = 100
 MAX_TRAILING_DISTANCE = 0.01
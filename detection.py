@@ -0,0 +1,82 @@
+"""
+Detection of hostile ships by the UAVs.
+"""
+import numpy as np
+
+import constants
+import general_maths as gm
+
+# ----------------------------------------------- LOGGER SET UP ------------------------------------------------
+import logging
+import datetime
+import os
+
+date = datetime.date.today()
+logging.basicConfig(level=logging.DEBUG, filename=os.path.join(os.getcwd(), 'logs/navy_log_' + str(date) + '.log'),
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt="%H:%M:%S")
+logger = logging.getLogger("DETECTION")
+logger.setLevel(logging.DEBUG)
+
+
+# --------------------------------------------- END LOGGER SET UP ------------------------------------------------
+
+# Weather parameter per sea state (index), sea states of 7 and over share the last one
+SEA_STATE_WEATHER_PARAMETERS = np.array([0.89, 0.89, 0.77, 0.68, 0.62, 0.53, 0.47, 0.40])
+UAV_HEIGHT = 10  # Assumed to be 10km
+
+
+def calculate_detection_probabilities(distances, rcs, sea_states) -> np.ndarray:
+    """
+    Probability that a UAV detects a ship in a single check, takes (broadcastable) arrays.
+    :param distances: Distances between the UAVs and the ships in km
+    :param rcs: Radar cross-sections of the ships
+    :param sea_states: Sea states at the ships
+    :return: Array of detection probabilities
+    """
+    weather = SEA_STATE_WEATHER_PARAMETERS[np.clip(sea_states, 0, len(SEA_STATE_WEATHER_PARAMETERS) - 1)]
+    top_frac_exp = constants.K_CONSTANT * UAV_HEIGHT * np.asarray(rcs) * weather
+    return 1 - np.exp(-top_frac_exp / np.maximum(distances, 1) ** 3)
+
+
+def detect_ship(drone, ships: list):
+    """
+    Rolls the detection checks of a drone against all ships, for the sub-step locations along the path it flew this
+    time step. The ships within the radius of a sub-step add to the detection probability as
+    1 - prod((1 - p) ^ (1 / splits)). Ships out of reach and ships that are already trailed are not checked.
+    :param drone: Drone that observes its area
+    :param ships: List of the ships that can be detected
+    :return: The first ship (in list order) that is detected, None if no ship is detected
+    """
+    ships = [ship for ship in ships if len(ship.trailing_agents) == 0]
+    if not ships:
+        return None
+
+    ship_x = np.array([ship.location.x for ship in ships], dtype=float)
+    ship_y = np.array([ship.location.y for ship in ships], dtype=float)
+    reach = drone.radius + drone.speed * constants.world.time_delta
+    in_reach = gm.calculate_distances(drone.location.x, drone.location.y, ship_x, ship_y) <= reach
+    if not in_reach.any():
+        return None
+    ships = [ship for ship, reachable in zip(ships, in_reach.tolist()) if reachable]
+    ship_x = ship_x[in_reach]
+    ship_y = ship_y[in_reach]
+    rcs = np.array([ship.RCS for ship in ships], dtype=float)
+    sea_states = constants.world.receptor_grid.get_sea_states([ship.location for ship in ships])
+
+    # Sub-step locations of the drone
+    splits = constants.world.splits_per_step
+    lamb = np.append(np.arange(0, 1, step=1 / splits), 1)
+    uav_x = drone.location.x * lamb + drone.last_location.x * (1 - lamb)
+    uav_y = drone.location.y * lamb + drone.last_location.y * (1 - lamb)
+
+    # Shape (ships, splits + 1)
+    distances = gm.calculate_distances(uav_x[np.newaxis, :], uav_y[np.newaxis, :],
+                                       ship_x[:, np.newaxis], ship_y[:, np.newaxis])
+    probabilities = calculate_detection_probabilities(distances, rcs[:, np.newaxis], sea_states[:, np.newaxis])
+    probabilities = np.where(distances <= drone.radius, probabilities, 0)
+    probability = 1 - np.prod((1 - probabilities) ** (1 / splits), axis=-1)
+
+    detected = np.flatnonzero(np.random.rand(len(ships)) <= probability)
+    if len(detected) == 0:
+        return None
+    return ships[int(detected[0])]
@@ -0,0 +1,200 @@
+"""
+Distance fields give the shortest sea distance from any location to a base, without creating a route.
+"""
+import heapq
+import math
+import time
+
+import numpy as np
+import shapely
+
+import constants
+import general_maths as gm
+from points import Point
+from routes import get_visibility_graph
+
+# ----------------------------------------------- LOGGER SET UP ------------------------------------------------
+import logging
+import datetime
+import os
+
+date = datetime.date.today()
+logging.basicConfig(level=logging.DEBUG, filename=os.path.join(os.getcwd(), 'logs/navy_log_' + str(date) + '.log'),
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt="%H:%M:%S")
+logger = logging.getLogger("DISTANCE_FIELDS")
+logger.setLevel(logging.DEBUG)
+
+
+# --------------------------------------------- END LOGGER SET UP ------------------------------------------------
+
+class SeaLattice:
+    """
+    The nodes of the receptor lattice (plus one row and column, so that every location in the grid has four
+    surrounding nodes) and the straight lines between neighbouring nodes that do not cross the obstacles.
+    Independent of the location measured to, so shared by all distance fields for the same obstacles.
+    """
+    # Half of the 16-neighbourhood, the edges are undirected
+    NEIGHBOUR_OFFSETS = [(0, 1), (1, 0), (1, 1), (1, -1), (1, 2), (2, 1), (1, -2), (2, -1)]
+
+    def __init__(self, polygons: list):
+        self.visibility_graph = get_visibility_graph(polygons)
+
+        self.min_x = constants.MIN_LAT - constants.LAT_GRID_EXTRA
+        self.min_y = constants.MIN_LONG - constants.LONG_GRID_EXTRA
+        max_x = constants.MAX_LAT + constants.LAT_GRID_EXTRA
+        max_y = constants.MAX_LONG + constants.LONG_GRID_EXTRA
+
+        self.max_rows = int((max_x - self.min_x) // constants.GRID_HEIGHT) + 1
+        self.max_cols = int((max_y - self.min_y) // constants.GRID_WIDTH) + 1
+
+        self.x = None
+        self.y = None
+        self.in_sea = None
+        self.adjacency = []
+        self.build_lattice()
+
+    def build_lattice(self) -> None:
+        t_0 = time.perf_counter()
+        graph = self.visibility_graph
+
+        rows, cols = np.meshgrid(np.arange(self.max_rows), np.arange(self.max_cols), indexing="ij")
+        self.x = (self.min_x + rows * constants.GRID_HEIGHT).ravel().astype(float)
+        self.y = (self.min_y + cols * constants.GRID_WIDTH).ravel().astype(float)
+        self.in_sea = ~shapely.contains_xy(graph.obstacle_geometry, self.x, self.y)
+
+        rows = rows.ravel()
+        cols = cols.ravel()
+        index_a = []
+        index_b = []
+        for row_offset, col_offset in self.NEIGHBOUR_OFFSETS:
+            neighbour_rows = rows + row_offset
+            neighbour_cols = cols + col_offset
+            valid = ((neighbour_rows < self.max_rows) & (0 <= neighbour_cols) & (neighbour_cols < self.max_cols))
+            index_a.append(np.flatnonzero(valid))
+            index_b.append(neighbour_rows[valid] * self.max_cols + neighbour_cols[valid])
+        index_a = np.concatenate(index_a)
+        index_b = np.concatenate(index_b)
+
+        at_sea = self.in_sea[index_a] & self.in_sea[index_b]
+        index_a = index_a[at_sea]
+        index_b = index_b[at_sea]
+        visible = graph.check_if_visible(self.x[index_a], self.y[index_a], self.x[index_b], self.y[index_b])
+        index_a = index_a[visible]
+        index_b = index_b[visible]
+        distances = gm.calculate_distances(self.x[index_a], self.y[index_a], self.x[index_b], self.y[index_b])
+
+        self.adjacency = [[] for _ in range(len(self.x))]
+        for a, b, distance in zip(index_a.tolist(), index_b.tolist(), distances.tolist()):
+            self.adjacency[a].append((b, distance))
+            self.adjacency[b].append((a, distance))
+
+        t_1 = time.perf_counter()
+        logger.debug(f"Built sea lattice of {self.max_rows}x{self.max_cols} nodes with {len(index_a)} edges "
+                     f"in {t_1 - t_0: .3f}s")
+
+
+sea_lattices = {}
+
+
+def get_sea_lattice(polygons: list) -> SeaLattice:
+    """
+    Returns the sea lattice for a set of obstacles, builds it if it does not exist yet
+    :param polygons: List of polygons to avoid
+    :return:
+    """
+    key = tuple(polygon.fingerprint for polygon in polygons)
+    if key not in sea_lattices:
+        sea_lattices[key] = SeaLattice(polygons)
+    return sea_lattices[key]
+
+
+class DistanceField:
+    """
+    Shortest distance (in km) from every node of the sea lattice to a single location, avoiding the obstacles.
+    Nodes that can see the location get the straight-line distance, the distance to the nodes in the shadow of
+    the obstacles follows from a Dijkstra pass over the lattice edges.
+    Nodes in or enclosed by the obstacles are infinitely far away.
+    """
+    def __init__(self, location: Point, polygons: list):
+        self.location = location
+        self.visibility_graph = get_visibility_graph(polygons)
+        self.lattice = get_sea_lattice(polygons)
+
+        self.distances = None
+        self.build_field()
+
+    def build_field(self) -> None:
+        t_0 = time.perf_counter()
+        graph = self.visibility_graph
+        lattice = self.lattice
+
+        costs = np.full(len(lattice.x), math.inf)
+        sea_nodes = np.flatnonzero(lattice.in_sea)
+        direct = sea_nodes[graph.check_if_visible(lattice.x[sea_nodes], lattice.y[sea_nodes],
+                                                  self.location.x, self.location.y)]
+        costs[direct] = gm.calculate_distances(lattice.x[direct], lattice.y[direct],
+                                               self.location.x, self.location.y)
+
+        queue = list(zip(costs[direct].tolist(), direct.tolist()))
+        heapq.heapify(queue)
+        while queue:
+            cost, node = heapq.heappop(queue)
+            if cost > costs[node]:
+                continue
+            for neighbour, distance in lattice.adjacency[node]:
+                new_cost = cost + distance
+                if new_cost < costs[neighbour]:
+                    costs[neighbour] = new_cost
+                    heapq.heappush(queue, (new_cost, neighbour))
+
+        self.distances = costs.reshape(lattice.max_rows, lattice.max_cols)
+
+        t_1 = time.perf_counter()
+        logger.debug(f"Built distance field to {self.location} in {t_1 - t_0: .3f}s")
+
+    def distance_from(self, point: Point) -> float:
+        """
+        Shortest distance from the point to the location, through one of the four surrounding lattice nodes.
+        An approximation - generally a little longer than the shortest route, but the short lattice legs can also add up
+        to slightly less (see DISTANCE_FIELD_MARGIN).
+        :param point: Location to measure from
+        :return: Distance in km, infinite if the point is outside the lattice or none of its nodes can be reached
+        """
+        graph = self.visibility_graph
+        lattice = self.lattice
+        if graph.is_visible(point, self.location):
+            return gm.calculate_distance(point, self.location)
+
+        row = int((point.x - lattice.min_x) // constants.GRID_HEIGHT)
+        col = int((point.y - lattice.min_y) // constants.GRID_WIDTH)
+        if not (0 <= row < lattice.max_rows - 1 and 0 <= col < lattice.max_cols - 1):
+            return math.inf
+
+        rows = np.array([row, row, row + 1, row + 1])
+        cols = np.array([col, col + 1, col, col + 1])
+        field = self.distances[rows, cols]
+        reachable = np.isfinite(field)
+        if not reachable.any():
+            return math.inf
+
+        node_x = lattice.min_x + rows[reachable] * constants.GRID_HEIGHT
+        node_y = lattice.min_y + cols[reachable] * constants.GRID_WIDTH
+        legs = np.where(graph.check_if_visible(point.x, point.y, node_x, node_y),
+                        gm.calculate_distances(node_x, node_y, point.x, point.y), math.inf)
+        return float(np.min(legs + field[reachable]))
+
+
+distance_fields = {}
+
+
+def get_distance_field(location: Point, polygons: list) -> DistanceField:
+    """
+    Returns the distance field to a location for a set of obstacles, builds it if it does not exist yet
+    :param location: Location the distances are measured to (generally a base)
+    :param polygons: List of polygons to avoid
+    :return:
+    """
+    key = (location.x, location.y, tuple(polygon.fingerprint for polygon in polygons))
+    if key not in distance_fields:
+        distance_fields[key] = DistanceField(location, polygons)
+    return distance_fields[key]
@@ -2,12 +2,11 @@ from agent import Agent
 from points import Point
 from base import Base
 
-from general_maths import calculate_distance
+from detection import detect_ship
 import constants
 import model_info
 from ships import Ship
 
-import math
 import copy
 import time
 import numpy as np
@@ -210,7 +209,8 @@ class Drone(Agent):
         if self.trailing:
             self.stop_trailing("Running Low On Endurance")
 
-        self.generate_route(self.base.location)
+        # Planned exactly - the endurance checks rely on the route home being no longer than the distance field
+        self.generate_route(self.base.location, use_cache=False)
         self.routing_to_base = True
 
     def land(self) -> None:
@@ -255,7 +255,8 @@ class Drone(Agent):
         if self.trailing:
             self.stop_trailing("Running Low On Endurance")
 
-        self.generate_route(self.base.location)
+        # Planned exactly - the endurance checks rely on the route home being no longer than the distance field
+        self.generate_route(self.base.location, use_cache=False)
         self.routing_to_base = True
 
     def reached_end_of_route(self) -> None:
@@ -287,75 +288,18 @@ class Drone(Agent):
         else:
             NotImplementedError("Exception - reached end of route, but not trailing, patrolling, or landing.")
 
-    @staticmethod
-    def roll_detection_check(uav_location, agent: Agent, distance: float = None) -> float:
-        if distance is None:
-            distance = calculate_distance(a=uav_location, b=agent.location)
-
-        # Get weather conditions in area
-        closest_receptor = constants.world.receptor_grid.get_closest_receptor(agent.location)
-        sea_state = closest_receptor.sea_state
-        sea_state_to_parameter = {0: 0.89,
-                                  1: 0.89,
-                                  2: 0.77,
-                                  3: 0.68,
-                                  4: 0.62,
-                                  5: 0.53,
-                                  6: 0.47}
-
-        if sea_state < 7:
-            weather = sea_state_to_parameter[sea_state]
-        else:
-            weather = 0.40
-
-        height = 10  # Assumed to be 10km
-        top_frac_exp = constants.K_CONSTANT * height * agent.RCS * weather
-        if distance < 1:
-            distance = 1
-        delta = 1 - math.exp(-top_frac_exp / (distance ** 3))
-        return delta
-
     def observe_area(self) -> None:
+        """
+        Roll the detection checks against all active hostile ships along the path flown this step, and start
+        trailing the first ship detected.
+        :return:
+        """
         t_0 = time.perf_counter()
-        active_hostile_ships = [agent
-                                for manager in constants.world.managers
-                                if manager.team != self.team
-                                for agent in manager.agents if (agent.left_world is False and agent.stationed is False)]
-        # [agent
-        # for manager in constants.world.managers
-        # for agent in manager.agents
-        # if agent.team != self.team]
-
-        for ship in active_hostile_ships:
-            detection_probabilities = []
-
-            radius_travelled = self.radius + self.speed * constants.world.time_delta
-
-            if calculate_distance(a=self.location, b=ship.location) > radius_travelled:
-                continue
-
-            if len(ship.trailing_agents) > 0:
-                continue
-
-            for lamb in np.append(np.arange(0, 1, step=1 / constants.world.splits_per_step), 1):
-                uav_location = Point(self.location.x * lamb + self.last_location.x * (1 - lamb),
-                                     self.location.y * lamb + self.last_location.y * (1 - lamb))
-                distance = calculate_distance(a=uav_location, b=ship.location)
-                if distance <= self.radius:
-                    detection_probabilities.append(self.roll_detection_check(uav_location, ship, distance))
-            probability = 1 - np.prod(
-                [(1 - p) ** (1 / constants.world.splits_per_step) for p in detection_probabilities])
-            if np.random.rand() <= probability:
-                # logger.debug(f"UAV {self.uav_id} detected {ship.ship_id} - w/ prob {probability}. "
-                #              f"- {self.routing_to_base=}")
-                if not self.routing_to_base:
-                    self.start_trailing(ship)
-                t_1 = time.perf_counter()
-                constants.time_spent_observing_area += (t_1 - t_0)
-                return
-            else:
-                # logger.debug(f"UAV {self.uav_id} failed to detect ship {ship.ship_id} - detect prob {probability}.")
-                pass
+        ship = detect_ship(self, constants.world.UAV_manager.get_active_hostile_ships())
+        if ship is not None:
+            # logger.debug(f"UAV {self.uav_id} detected {ship.ship_id}. - {self.routing_to_base=}")
+            if not self.routing_to_base:
+                self.start_trailing(ship)
 
         t_1 = time.perf_counter()
         constants.time_spent_observing_area += (t_1 - t_0)
@@ -409,10 +353,7 @@ class Drone(Agent):
 
     def generate_patrol_location(self) -> Point:
         points = [self.sample_random_patrol_start() for _ in range(constants.PATROL_LOCATIONS)]
-        concentration_of_pheromones = []
-        for point in points:
-            cop, _ = constants.world.receptor_grid.calculate_CoP(point, self.radius)
-            concentration_of_pheromones.append(cop)
+        concentration_of_pheromones = constants.world.receptor_grid.calculate_CoP_batch(points, self.radius).tolist()
         # currently selecting minimal location - could do weight based sampling instead
         min_index = concentration_of_pheromones.index(min(concentration_of_pheromones))
         return points[min_index]
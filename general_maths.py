@@ -2,8 +2,12 @@ import math
 import constants
 
 import time
+import numpy as np
+import shapely
 import shapely.geometry
 
+from geography import polygons_near_point
+
 # ----------------------------------------------- LOGGER SET UP ------------------------------------------------
 import logging
 import datetime
@@ -41,6 +45,46 @@ def calculate_distance(a: object, b: object, lon_lat_to_km=True) -> float:
     return distance
 
 
+def calculate_distances(x_a, y_a, x_b, y_b) -> np.ndarray:
+    """
+    Vectorized version of calculate_distance, takes (broadcastable) arrays of coordinates
+    :param x_a: x-coordinates of the first points
+    :param y_a: y-coordinates of the first points
+    :param x_b: x-coordinates of the second points
+    :param y_b: y-coordinates of the second points
+    :return: Array of distances in km
+    """
+    t_0 = time.perf_counter()
+
+    latitudinal_distance_in_km = np.abs((np.asarray(y_a) - y_b) * constants.LATITUDE_CONVERSION_FACTOR)
+    mean_latitude = (np.asarray(y_a) + y_b) / 2
+    longitudinal_distance_in_km = np.abs((np.asarray(x_a) - x_b) * (constants.LONGITUDE_CONVERSION_FACTOR *
+                                                                    np.cos(np.radians(mean_latitude))))
+    distances = np.sqrt(latitudinal_distance_in_km ** 2 + longitudinal_distance_in_km ** 2)
+
+    t_1 = time.perf_counter()
+    constants.time_spent_calculating_distance += (t_1 - t_0)
+    return distances
+
+
+def calculate_lower_bound_distances(x_a, y_a, x_b, y_b, max_latitude: float) -> np.ndarray:
+    """
+    Lower bound on the length (as calculate_distances measures it) of any route from a to b that stays within
+    max_latitude of the equator. calculate_distances scales each leg by the cosine of its own mean latitude, so leg
+    lengths do not add up - scaling by the smallest cosine on the way gives a norm, which no route can beat.
+    :param x_a: x-coordinates of the first points
+    :param y_a: y-coordinates of the first points
+    :param x_b: x-coordinates of the second points
+    :param y_b: y-coordinates of the second points
+    :param max_latitude: Largest absolute latitude of any point on the route
+    :return: Array of distances in km
+    """
+    latitudinal_distance_in_km = np.abs((np.asarray(y_a) - y_b) * constants.LATITUDE_CONVERSION_FACTOR)
+    longitudinal_distance_in_km = np.abs((np.asarray(x_a) - x_b) * (constants.LONGITUDE_CONVERSION_FACTOR *
+                                                                    math.cos(math.radians(min(max_latitude, 90)))))
+    return np.sqrt(latitudinal_distance_in_km ** 2 + longitudinal_distance_in_km ** 2)
+
+
 def longitudinal_distance_to_km(lon_1: float, lon_2: float) -> float:
     return abs((lon_1 - lon_2) * constants.LATITUDE_CONVERSION_FACTOR)
 
@@ -93,6 +137,26 @@ def is_between_points(a: object, b: object, tested_point: object) -> bool:
     return True
 
 
+def is_between_points_array(a: np.ndarray, b: np.ndarray, tested_point: object) -> np.ndarray:
+    """
+    Vectorized version of is_between_points, checks a single point against multiple lines at once
+    :param a: Array of shape (N, 2) with the start points of the lines
+    :param b: Array of shape (N, 2) with the end points of the lines
+    :param tested_point: Point
+    :return: Boolean array of shape (N,)
+    """
+    d_x = b[:, 0] - a[:, 0]
+    d_y = b[:, 1] - a[:, 1]
+    t_x = tested_point.x - a[:, 0]
+    t_y = tested_point.y - a[:, 1]
+
+    cross_product = t_y * d_x - t_x * d_y
+    dot_product = t_x * d_x + t_y * d_y
+    squared_length = d_x * d_x + d_y * d_y
+
+    return (np.abs(cross_product) <= 0.001) & (dot_product >= 0) & (dot_product <= squared_length)
+
+
 def orientation(p: object, q: object, r: object) -> int:
     """
     Return numerical orientation
@@ -194,33 +258,72 @@ def check_if_path_and_polygon_intersect(polygon_line: list, path_line: list, exc
     :param path_line:
     :return:
     """
+    edges = np.array([[[polygon_line[0].x, polygon_line[0].y], [polygon_line[1].x, polygon_line[1].y]]])
+    return bool(check_if_paths_and_edges_intersect(np.array([path_line[0].x, path_line[0].y]),
+                                                   np.array([path_line[1].x, path_line[1].y]),
+                                                   edges, except_end_points=except_end_points)[0])
+
+
+def check_if_paths_and_edges_intersect(path_start: np.ndarray, path_end: np.ndarray, edges: np.ndarray,
+                                       except_end_points=True) -> np.ndarray:
+    """
+    Vectorized check_if_path_and_polygon_intersect - checks one or more path lines against all polygon edges at once.
+    The path line endpoints are allowed to be on (or be) the edges, but the reverse is not allowed.
+    :param path_start: Array of shape (2,) or (N, 2) with the start point(s) of the path line(s)
+    :param path_end: Array of shape (2,) or (N, 2) with the end point(s) of the path line(s)
+    :param edges: Array of shape (E, 2, 2) with the start and end point of every edge
+    :param except_end_points: Include or except endpoints in the check
+    :return: Boolean array of shape (E,) or (N, E), True if the path line intersects the edge
+    """
+    a = np.asarray(path_start, dtype=float)[..., np.newaxis, :]
+    b = np.asarray(path_end, dtype=float)[..., np.newaxis, :]
+    c = edges[:, 0]
+    d = edges[:, 1]
+
+    def cross(p, q, r):
+        return (q[..., 0] - p[..., 0]) * (r[..., 1] - p[..., 1]) - (q[..., 1] - p[..., 1]) * (r[..., 0] - p[..., 0])
+
+    def on_segment(p, q, r):
+        # q is within the bounding box of p and r (only used for collinear points)
+        return ((np.minimum(p[..., 0], r[..., 0]) <= q[..., 0]) & (q[..., 0] <= np.maximum(p[..., 0], r[..., 0])) &
+                (np.minimum(p[..., 1], r[..., 1]) <= q[..., 1]) & (q[..., 1] <= np.maximum(p[..., 1], r[..., 1])))
+
+    o_1 = np.sign(cross(a, b, c))
+    o_2 = np.sign(cross(a, b, d))
+    o_3 = np.sign(cross(c, d, a))
+    o_4 = np.sign(cross(c, d, b))
+
+    intersect = (o_1 != o_2) & (o_3 != o_4)
+    intersect |= (o_1 == 0) & on_segment(a, c, b)
+    intersect |= (o_2 == 0) & on_segment(a, d, b)
+    intersect |= (o_3 == 0) & on_segment(c, a, d)
+    intersect |= (o_4 == 0) & on_segment(c, b, d)
+    # Zero-length lines do not intersect anything
+    intersect &= (a != b).any(axis=-1) & (c != d).any(axis=-1)
 
-    geo_path_line = shapely.geometry.LineString([[path_line[0].x, path_line[0].y], [path_line[1].x, path_line[1].y]])
-    geo_poly_line = shapely.geometry.LineString([[polygon_line[0].x, polygon_line[0].y],
-                                                 [polygon_line[1].x, polygon_line[1].y]])
     if except_end_points:
         # Except if the line shares an endpoint - passing through 2 points on the polygon is handled in the polygon
-        if (path_line[0] == polygon_line[0]
-                or path_line[1] == polygon_line[0]
-                or path_line[0] == polygon_line[1]
-                or path_line[1] == polygon_line[1]):
-            return False
-        # case if point is exactly on the line
-        elif (check_if_point_on_line(point=shapely.geometry.Point(path_line[0].x, path_line[0].y),
-                                     line=geo_poly_line)
-              or check_if_point_on_line(point=shapely.geometry.Point(path_line[1].x, path_line[1].y),
-                                        line=geo_poly_line)
-              # WE DO NOT WANT TO EXCEPT IT WHEN THE POLYGON LINE ENDPOINT IS ON THE PATH LINE
-              # or check_if_point_on_line(point=shapely.geometry.Point(polygon_line[0].x, polygon_line[0].y),
-              #                           line=geo_path_line)
-              # or check_if_point_on_line(point=shapely.geometry.Point(polygon_line[1].x, polygon_line[1].y),
-              #                           line=geo_path_line)
-        ):
-            return False
-    intersect = geo_path_line.intersects(geo_poly_line)
+        shares_end_point = ((a == c).all(axis=-1) | (a == d).all(axis=-1) |
+                            (b == c).all(axis=-1) | (b == d).all(axis=-1))
+        # case if a path point is (almost) exactly on the edge - NOT when the edge endpoint is on the path line
+        on_edge = (distance_to_segments(a, c, d) < 1e-8) | (distance_to_segments(b, c, d) < 1e-8)
+        intersect &= ~(shares_end_point | on_edge)
     return intersect
 
 
+def distance_to_segments(point: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    """
+    Vectorized (coordinate) distance from points to the line segments from start to end
+    """
+    direction = end - start
+    length_squared = (direction ** 2).sum(axis=-1)
+    t = np.divide(((point - start) * direction).sum(axis=-1), length_squared,
+                  out=np.zeros(np.broadcast_shapes(length_squared.shape, point.shape[:-1])),
+                  where=length_squared > 0)
+    closest = start + np.clip(t, 0, 1)[..., np.newaxis] * direction
+    return np.sqrt(((point - closest) ** 2).sum(axis=-1))
+
+
 def check_if_point_on_line(point, line):
     if isinstance(line, list):
         line = shapely.geometry.LineString([[line[0].x, line[0].y], [line[1].x, line[1].y]])
@@ -233,58 +336,36 @@ def check_if_point_on_line(point, line):
         return False
 
 
-def maximize_concavity(path: list, polygons: list) -> list:
+def pull_path_taut(path: list, polygons: list) -> list:
     """
-    Check if some parts of the provided route is concave - See if we can remove points inbetween
-    without violating any polygons and retaining required points
+    Shorten a path by skipping every point that is not needed to get around the polygons (string pulling).
+    From the last kept point, jump to the furthest point along the path that can be reached in a straight line.
+    Every jump checks the lines to all remaining points at once against the interiors of the polygons.
+    The consecutive points of the given path are assumed to be reachable from each other.
     :param path: list of points across which is travelled
-    :param polygons:
-    :return:
+    :param polygons: List of polygons to avoid
+    :return: Path from the same first to the same last point, through a subset of the points in the same order
     """
-    # logger.debug(f"Maximizing concavity for path {[str(p) for p in path]}")
-    shorter_route = [path[0]]
+    # logger.debug(f"Pulling path taut {[str(p) for p in path]}")
+    if len(path) <= 2:
+        return list(path)
 
+    coordinates = np.array([(p.x, p.y) for p in path])
+    interiors = [polygon.interior_geometry for polygon in polygons if not polygon.interior_geometry.is_empty]
+
+    shorter_route = [path[0]]
     i = 0
-    j = len(path) - 1
-
-    iterations = 0
-
-    while i < len(path):
-        p_i = path[i]
-        # logger.debug(f"{i=}, {str(p_i)=}, {j=}, {len(path)=}")
-        iterations += 1
-        if iterations > constants.ITERATION_LIMIT:
-            raise TimeoutError("Concavity Optimization Not Converging.")
-
-        # Otherwise take j the furthest away
-        # if not maintain_point:
-        p_j = path[j]
-        # logger.debug(f"Taking furthest point {str(p_j)}")
-
-        i_to_j = not any([polygon.check_if_line_through_polygon(p_i, p_j) for polygon in polygons])
-        if j == len(path) - 1 and i_to_j:
-            shorter_route.append(path[-1])
-
-            # logger.debug(f"Able to reach end of path going from {p_i} to {path[-1]} - returning"
-            #              f"{[str(p) for p in shorter_route]}")
-            return shorter_route
-
-        # if we can't go further than 1 step, make that step (we know it is feasible)
-        if j == i + 1:
-            shorter_route.append(path[j])
-            i = j
-            j = len(path) - 1
-            # logger.debug(f"Can't make more than one step, going from {p_i} to {p_j}")
-            continue
-
-        if i_to_j:
-            shorter_route.append(p_j)
-            i = j
-            j = len(path) - 1
-            # logger.debug(f"Going from {p_i} to {p_j} (latest feasible option)")
-        else:
-            j -= 1
-            # logger.debug(f"Not feasible - reducing j")
+    while i < len(path) - 1:
+        lines = shapely.linestrings(np.stack(np.broadcast_arrays(coordinates[i], coordinates[i + 1:]), axis=1))
+        obstructed = np.zeros(len(lines), dtype=bool)
+        for interior in interiors:
+            obstructed |= shapely.intersects(lines, interior)
+
+        reachable = np.flatnonzero(~obstructed)
+        # The next point is always reachable, also when the line to it just grazes a polygon
+        i = i + 1 + (reachable[-1] if len(reachable) > 0 else 0)
+        shorter_route.append(path[i])
+    return shorter_route
 
 
 def calculate_direction_vector(point_a: object, point_b: object) -> list:
@@ -324,13 +405,13 @@ def calculate_polar_angle(a: object, b: object) -> float:
 def graham_scan(points: list) -> list:
     """
     Applies Graham Scan algorithm to make a convex hull out of a set of points.
-    An exception is when the graham scan receives points with "force_maintain" characteristics
-    This will create a non-convex hull that ensures that these points are contained
+    The list of points is not modified - the points may belong to (shared) polygons.
     :param points: List of Points objects
     :return:
     """
     # logger.debug("STARTING GRAHAM SCAN")
     # logger.debug(f"Received points: {[str(point) for point in points]}")
+    points = points.copy()
 
     starting_point = find_lowest_point_in_polygon(points)
     points.remove(starting_point)
@@ -386,7 +467,7 @@ def find_closest_reachable_point(target: object, polygon: object) -> object:
 
 
 def check_if_point_in_polygons(polygons, point, exclude_edges=True) -> bool:
-    for polygon in polygons:
+    for polygon in polygons_near_point(polygons, point):
         if polygon.check_if_contains_point(point, exclude_edges=exclude_edges):
             return True
     return False
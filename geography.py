@@ -0,0 +1,366 @@
+"""
+Spatial index over the geography (landmasses and zones).
+Answers which polygons a point or line can touch without scanning every polygon.
+"""
+import hashlib
+import math
+import time
+
+import numpy as np
+import shapely
+import shapely.geometry
+
+import constants
+
+# ----------------------------------------------- LOGGER SET UP ------------------------------------------------
+import logging
+import datetime
+import os
+
+date = datetime.date.today()
+logging.basicConfig(level=logging.DEBUG, filename=os.path.join(os.getcwd(), 'logs/navy_log_' + str(date) + '.log'),
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt="%H:%M:%S")
+logger = logging.getLogger("GEOGRAPHY")
+logger.setLevel(logging.DEBUG)
+
+
+# --------------------------------------------- END LOGGER SET UP ------------------------------------------------
+
+def save_cache_file(cache_file: str, save_function, *args, **kwargs) -> None:
+    """
+    Write a cache file with one of the NumPy save functions (np.save, np.savez, ...).
+    Written under a temporary name first, so parallel runs never load a partial file.
+    :param cache_file: Path of the cache file
+    :param save_function: Function that writes the arrays to an open file
+    :param args: Arrays passed on to the save function
+    :param kwargs: Named arrays passed on to the save function
+    """
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temporary_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(temporary_file, "wb") as file:
+        save_function(file, *args, **kwargs)
+    os.replace(temporary_file, cache_file)
+
+
+class GeographyIndex:
+    """
+    STR-tree over the bounding boxes of a list of polygons.
+    Queries return the indices of candidate polygons (bounding box touched) in the order of the original list,
+    the exact checks are left to the polygons themselves.
+    The index is shared between copies of the same geography, so indices are returned rather than polygons.
+    """
+    def __init__(self, polygons: list):
+        # Empty polygons (e.g. zones without coordinates) can not be touched and are left out of the tree
+        self.polygon_indices = np.array([index for index, polygon in enumerate(polygons)
+                                         if not polygon.geometry.is_empty], dtype=int)
+        boxes = [shapely.box(*polygons[index].bounding_box) for index in self.polygon_indices]
+        self.tree = shapely.STRtree(boxes)
+
+    def query_point(self, point) -> np.ndarray:
+        """
+        Select the polygons of which the bounding box contains the point
+        :param point: Point object
+        :return: Sorted array of polygon indices
+        """
+        tree_indices = self.tree.query(shapely.geometry.Point(point.x, point.y), predicate="intersects")
+        return np.sort(self.polygon_indices[tree_indices])
+
+    def query_segment(self, p_1, p_2) -> np.ndarray:
+        """
+        Select the polygons of which the bounding box is crossed by the line from p_1 to p_2
+        :param p_1: Start Point
+        :param p_2: End Point
+        :return: Sorted array of polygon indices
+        """
+        line = shapely.geometry.LineString([(p_1.x, p_1.y), (p_2.x, p_2.y)])
+        tree_indices = self.tree.query(line, predicate="intersects")
+        return np.sort(self.polygon_indices[tree_indices])
+
+    def query_points(self, x, y) -> (np.ndarray, np.ndarray):
+        """
+        Bulk version of query_point
+        :param x: Array of x-coordinates
+        :param y: Array of y-coordinates
+        :return: Arrays of (point index, polygon index) pairs, sorted by point index
+        """
+        point_indices, tree_indices = self.tree.query(shapely.points(x, y), predicate="intersects")
+        return point_indices, self.polygon_indices[tree_indices]
+
+    def query_segments(self, x_a, y_a, x_b, y_b) -> (np.ndarray, np.ndarray):
+        """
+        Bulk version of query_segment
+        :param x_a: Array of x-coordinates of the start points
+        :param y_a: Array of y-coordinates of the start points
+        :param x_b: Array of x-coordinates of the end points
+        :param y_b: Array of y-coordinates of the end points
+        :return: Arrays of (segment index, polygon index) pairs, sorted by segment index
+        """
+        start = np.stack([x_a, y_a], axis=-1)
+        end = np.stack([x_b, y_b], axis=-1)
+        lines = shapely.linestrings(np.stack([start, end], axis=-2))
+        segment_indices, tree_indices = self.tree.query(lines, predicate="intersects")
+        return segment_indices, self.polygon_indices[tree_indices]
+
+
+geography_indices = {}
+
+
+def get_geography_index(polygons: list) -> GeographyIndex:
+    """
+    Returns the index for a list of polygons, builds it if it does not exist yet
+    :param polygons: List of polygons
+    :return:
+    """
+    key = tuple(polygon.fingerprint for polygon in polygons)
+    if key not in geography_indices:
+        geography_indices[key] = GeographyIndex(polygons)
+    return geography_indices[key]
+
+
+def polygons_near_point(polygons: list, point) -> list:
+    """
+    Select the polygons out of the list that the point can be in
+    """
+    return [polygons[index] for index in get_geography_index(polygons).query_point(point)]
+
+
+def polygons_near_segment(polygons: list, p_1, p_2) -> list:
+    """
+    Select the polygons out of the list that the line from p_1 to p_2 can touch
+    """
+    return [polygons[index] for index in get_geography_index(polygons).query_segment(p_1, p_2)]
+
+
+class PolygonRaster:
+    """
+    Rasterized masks of a list of polygons over the frame of the receptor grid.
+    Cells are centred on multiples of the cell size from the grid origin, so the receptors are cell centres.
+    Every mask is an integer per cell, of which bit i refers to polygon i:
+        inside: the cell lies within the polygon and is not touched by any of its edges
+        boundary: an edge of the polygon passes through the cell - points in these cells are checked exactly
+        center: the cell centre lies within the polygon (edges included)
+    The masks are cached on disk, keyed by a hash of the polygon coordinates and the grid constants.
+    """
+    EDGE_TOLERANCE = 0.001  # As general_maths.is_between_points_array
+    MAX_POLYGONS = 64
+
+    def __init__(self, polygons: list, cell_size: float = constants.RASTER_CELL_SIZE):
+        if len(polygons) > self.MAX_POLYGONS:
+            raise ValueError(f"Can not rasterize more than {self.MAX_POLYGONS} polygons at once")
+        self.polygons = polygons
+        self.cell_size = cell_size
+
+        self.min_x = constants.MIN_LAT - constants.LAT_GRID_EXTRA
+        self.min_y = constants.MIN_LONG - constants.LONG_GRID_EXTRA
+        max_x = constants.MAX_LAT + constants.LAT_GRID_EXTRA
+        max_y = constants.MAX_LONG + constants.LONG_GRID_EXTRA
+        self.max_rows = int(round((max_x - self.min_x) / cell_size)) + 1
+        self.max_cols = int(round((max_y - self.min_y) / cell_size)) + 1
+
+        self.inside = None
+        self.boundary = None
+        self.center = None
+        self.cache_file = self.make_cache_file()
+        if not self.load_raster():
+            self.build_raster()
+            self.save_raster()
+
+    def make_cache_file(self) -> str | None:
+        """
+        Cache file of the raster, None if caching is disabled
+        """
+        if constants.CACHE_DIRECTORY is None:
+            return None
+        key = hashlib.sha1()
+        for value in [self.cell_size, self.EDGE_TOLERANCE, constants.MIN_LAT, constants.MAX_LAT,
+                      constants.MIN_LONG, constants.MAX_LONG, constants.LAT_GRID_EXTRA, constants.LONG_GRID_EXTRA]:
+            key.update(np.float64(value).tobytes())
+        for polygon in self.polygons:
+            key.update(np.int64(len(polygon.vertices)).tobytes())
+            key.update(polygon.vertices.tobytes())
+        return os.path.join(os.getcwd(), constants.CACHE_DIRECTORY, f"raster_{key.hexdigest()}.npz")
+
+    def load_raster(self) -> bool:
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return False
+        with np.load(self.cache_file) as masks:
+            self.inside = masks["inside"]
+            self.boundary = masks["boundary"]
+            self.center = masks["center"]
+        logger.debug(f"Loaded raster of {self.max_rows}x{self.max_cols} cells from {self.cache_file}")
+        return True
+
+    def save_raster(self) -> None:
+        if self.cache_file is None:
+            return
+        save_cache_file(self.cache_file, np.savez_compressed, inside=self.inside, boundary=self.boundary,
+                        center=self.center)
+
+    def build_raster(self) -> None:
+        t_0 = time.perf_counter()
+        rows, cols = np.meshgrid(np.arange(self.max_rows), np.arange(self.max_cols), indexing="ij")
+        center_x = (self.min_x + rows * self.cell_size).ravel()
+        center_y = (self.min_y + cols * self.cell_size).ravel()
+        half = self.cell_size / 2
+
+        inside = np.zeros(len(center_x), dtype=np.uint64)
+        boundary = np.zeros(len(center_x), dtype=np.uint64)
+        center = np.zeros(len(center_x), dtype=np.uint64)
+        for index, polygon in enumerate(self.polygons):
+            if polygon.geometry.is_empty:
+                continue
+            bit = np.uint64(1 << index)
+
+            # Points count as on an edge up to a cross product of EDGE_TOLERANCE, so EDGE_TOLERANCE / length away
+            on_edge = np.zeros(len(center_x), dtype=bool)
+            lengths = np.linalg.norm(polygon.edges[:, 1] - polygon.edges[:, 0], axis=1)
+            if (lengths == 0).any():
+                # Every point is on a zero-length edge, the whole polygon is checked exactly
+                on_edge[self.cells_in_bounds(*polygon.bounding_box)] = True
+            else:
+                edges = shapely.buffer(shapely.linestrings(polygon.edges), self.EDGE_TOLERANCE / lengths)
+                for edge, bounds in zip(edges, shapely.bounds(edges)):
+                    candidates = self.cells_in_bounds(*bounds)
+                    candidates = candidates[~on_edge[candidates]]
+                    cells = shapely.box(center_x[candidates] - half, center_y[candidates] - half,
+                                        center_x[candidates] + half, center_y[candidates] + half)
+                    on_edge[candidates[shapely.intersects(edge, cells)]] = True
+            boundary[on_edge] |= bit
+
+            # Away from the edges the outcome of a containment check is the same for every point in a cell,
+            # so the centre decides for the whole cell
+            candidates = self.cells_in_bounds(*polygon.bounding_box)
+            candidates = candidates[~on_edge[candidates]]
+            inside[candidates[shapely.contains_xy(polygon.geometry, center_x[candidates],
+                                                  center_y[candidates])]] |= bit
+
+            center[inside & bit != 0] |= bit
+            for cell in np.flatnonzero(on_edge):
+                if polygon.check_if_contains_point(shapely.geometry.Point(center_x[cell], center_y[cell]),
+                                                   exclude_edges=False):
+                    center[cell] |= bit
+
+        self.inside = inside.reshape(self.max_rows, self.max_cols)
+        self.boundary = boundary.reshape(self.max_rows, self.max_cols)
+        self.center = center.reshape(self.max_rows, self.max_cols)
+
+        t_1 = time.perf_counter()
+        logger.debug(f"Built raster of {self.max_rows}x{self.max_cols} cells "
+                     f"({int(np.count_nonzero(self.boundary))} boundary cells) in {t_1 - t_0: .3f}s")
+
+    def cells_in_bounds(self, min_x: float, min_y: float, max_x: float, max_y: float) -> np.ndarray:
+        """
+        Flat indices of the cells that overlap a bounding box
+        """
+        min_row = max(int(np.floor((min_x - self.min_x) / self.cell_size + 0.5)), 0)
+        max_row = min(int(np.floor((max_x - self.min_x) / self.cell_size + 0.5)) + 1, self.max_rows)
+        min_col = max(int(np.floor((min_y - self.min_y) / self.cell_size + 0.5)), 0)
+        max_col = min(int(np.floor((max_y - self.min_y) / self.cell_size + 0.5)) + 1, self.max_cols)
+        if min_row >= max_row or min_col >= max_col:
+            return np.zeros(0, dtype=int)
+        rows, cols = np.meshgrid(np.arange(min_row, max_row), np.arange(min_col, max_col), indexing="ij")
+        return (rows * self.max_cols + cols).ravel()
+
+    def check_exactly(self, x: float, y: float, exclude_edges=True) -> bool:
+        point = shapely.geometry.Point(x, y)
+        for polygon in polygons_near_point(self.polygons, point):
+            if polygon.check_if_contains_point(point, exclude_edges=exclude_edges):
+                return True
+        return False
+
+    def locate_cells(self, x, y) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Cells of an array of locations
+        :param x: Array of x-coordinates
+        :param y: Array of y-coordinates
+        :return: Arrays of the rows, columns and whether the location is within the raster
+        """
+        rows = np.floor((np.asarray(x) - self.min_x) / self.cell_size + 0.5).astype(int)
+        cols = np.floor((np.asarray(y) - self.min_y) / self.cell_size + 0.5).astype(int)
+        in_raster = (0 <= rows) & (rows < self.max_rows) & (0 <= cols) & (cols < self.max_cols)
+        return np.clip(rows, 0, self.max_rows - 1), np.clip(cols, 0, self.max_cols - 1), in_raster
+
+    def at_centers(self, x: np.ndarray, y: np.ndarray, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        return ((np.abs(x - (self.min_x + rows * self.cell_size)) < 1e-9) &
+                (np.abs(y - (self.min_y + cols * self.cell_size)) < 1e-9))
+
+    def contains_points(self, x, y, exclude_edges=True) -> np.ndarray:
+        """
+        Vectorized version of check_if_point_in_polygons.
+        Looks up the cells of the locations, only locations in boundary cells (or outside the raster) are
+        checked against the polygons themselves.
+        :param x: Array of x-coordinates
+        :param y: Array of y-coordinates
+        :param exclude_edges: Whether points on the polygon edges count as outside
+        :return: Boolean array
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        rows, cols, in_raster = self.locate_cells(x, y)
+        contained = in_raster & (self.inside[rows, cols] != 0)
+        uncertain = ~contained & (~in_raster | (self.boundary[rows, cols] != 0))
+        if not exclude_edges:
+            # Cell centres (e.g. receptors) have been checked while building the raster
+            known = uncertain & in_raster & self.at_centers(x, y, rows, cols)
+            contained[known] = self.center[rows[known], cols[known]] != 0
+            uncertain &= ~known
+        for index in np.flatnonzero(uncertain):
+            contained[index] = self.check_exactly(x[index], y[index], exclude_edges=exclude_edges)
+        return contained
+
+    def contains_point(self, point, exclude_edges=True) -> bool:
+        return bool(self.contains_points(point.x, point.y, exclude_edges=exclude_edges)[0])
+
+    def polygon_contains_points(self, polygon_index: int, x, y, exclude_edges=True) -> np.ndarray:
+        """
+        Vectorized check_if_contains_point of a single polygon out of the list
+        :param polygon_index: Index of the polygon in the rasterized list
+        :param x: Array of x-coordinates
+        :param y: Array of y-coordinates
+        :param exclude_edges: Whether points on the polygon edges count as outside
+        :return: Boolean array
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        bit = np.uint64(1 << polygon_index)
+        rows, cols, in_raster = self.locate_cells(x, y)
+        contained = in_raster & (self.inside[rows, cols] & bit != 0)
+        uncertain = ~in_raster | (self.boundary[rows, cols] & bit != 0)
+        polygon = self.polygons[polygon_index]
+        for index in np.flatnonzero(uncertain):
+            contained[index] = polygon.check_if_contains_point(shapely.geometry.Point(x[index], y[index]),
+                                                               exclude_edges=exclude_edges)
+        return contained
+
+    def polygon_contains_point(self, polygon_index: int, point, exclude_edges=True) -> bool:
+        """
+        Scalar version of polygon_contains_points
+        """
+        polygon = self.polygons[polygon_index]
+        if not polygon.bounding_box_contains(point.x, point.y):
+            return False
+
+        row = math.floor((point.x - self.min_x) / self.cell_size + 0.5)
+        col = math.floor((point.y - self.min_y) / self.cell_size + 0.5)
+        if 0 <= row < self.max_rows and 0 <= col < self.max_cols:
+            bit = 1 << polygon_index
+            if self.inside.item(row, col) & bit:
+                return True
+            if not self.boundary.item(row, col) & bit:
+                return False
+        return polygon.check_if_contains_point(point, exclude_edges=exclude_edges)
+
+
+polygon_rasters = {}
+
+
+def get_polygon_raster(polygons: list) -> PolygonRaster:
+    """
+    Returns the raster of a list of polygons, builds it if it does not exist yet
+    :param polygons: List of polygons
+    :return:
+    """
+    key = (tuple(polygon.fingerprint for polygon in polygons), constants.RASTER_CELL_SIZE)
+    if key not in polygon_rasters:
+        polygon_rasters[key] = PolygonRaster(polygons)
+    return polygon_rasters[key]
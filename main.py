@@ -13,6 +13,9 @@ def animation_function(frame):
 
 anim_created = FuncAnimation(test_world.fig, animation_function, frames=5 * 72, interval=100, repeat=False)
 
-anim_created.save("animated_arrivals.mp4", writer="ffmpeg")
+try:
+    anim_created.save("animated_arrivals.mp4", writer="ffmpeg")
+finally:
+    test_world.close()
 
 print("Simulation Completed.")
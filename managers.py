@@ -206,6 +206,9 @@ class UAVManager(AgentManager):
         self.team = 2
         self.drone_types = []
 
+        # Hostile ships collected once per turn, the ships do not move during the turn of the UAV manager
+        self.active_hostile_ships = None
+
         self.initiate_bases()
         self.initiate_drones()
         self.calculate_utilization_rates()
@@ -213,13 +216,28 @@ class UAVManager(AgentManager):
     def __str__(self):
         return "UAV Agent Manager"
 
+    def manage_agents(self):
+        self.active_hostile_ships = None
+        super().manage_agents()
+
+    def get_active_hostile_ships(self) -> list:
+        """
+        Ships of the other teams that are in the world, for the drones to observe.
+        Collected on the first call of the turn, ships that leave the world during the turn are left out.
+        :return:
+        """
+        if self.active_hostile_ships is None:
+            self.active_hostile_ships = [agent
+                                         for manager in constants.world.managers
+                                         if manager.team != self.team
+                                         for agent in manager.agents
+                                         if (agent.left_world is False and agent.stationed is False)]
+        return [ship for ship in self.active_hostile_ships if ship.left_world is False and ship.stationed is False]
+
     def initiate_bases(self):
-        self.bases = [Airbase(name="Ningbo", location=Point(121.57, 29.92,
-                                                            force_maintain=True, name="Ningbo")),
-                      Airbase(name="Fuzhou", location=Point(119.31, 26.00,
-                                                            force_maintain=True, name="Fuzhou")),
-                      Airbase(name="Liangcheng", location=Point(116.75, 25.68,
-                                                                force_maintain=True, name="Liangcheng")),
+        self.bases = [Airbase(name="Ningbo", location=Point(121.57, 29.92, name="Ningbo")),
+                      Airbase(name="Fuzhou", location=Point(119.31, 26.00, name="Fuzhou")),
+                      Airbase(name="Liangcheng", location=Point(116.75, 25.68, name="Liangcheng")),
                       ]
 
     def initiate_drones(self):
@@ -311,16 +329,16 @@ class MerchantManager(AgentManager):
 
     def initiate_bases(self) -> None:
         self.bases = [Harbour(name="Kaohsiung",
-                              location=Point(120.30, 22.44, name="Kaohsiung", force_maintain=True),
+                              location=Point(120.30, 22.44, name="Kaohsiung"),
                               probability=0.4),
                       Harbour(name="Tiachung",
-                              location=Point(120.42, 24.21, name="Tiachung", force_maintain=True),
+                              location=Point(120.42, 24.21, name="Tiachung"),
                               probability=0.3),
                       Harbour(name="Keelung",
-                              location=Point(121.75, 25.19, name="Keelung", force_maintain=True),
+                              location=Point(121.75, 25.19, name="Keelung"),
                               probability=0.25),
                       Harbour(name="Hualien",
-                              location=Point(121.70, 23.96, name="Hualien", force_maintain=True),
+                              location=Point(121.70, 23.96, name="Hualien"),
                               probability=0.05)
                       ]
 
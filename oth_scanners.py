@@ -66,9 +66,9 @@ class OTH:
         self.update_range_band_plot()
 
     @staticmethod
-    def detected_agent(agent) -> bool:
-        receptor = constants.world.receptor_grid.get_closest_receptor(agent.location)
-        sea_state = receptor.sea_state
+    def detected_agent(agent, sea_state: int = None) -> bool:
+        if sea_state is None:
+            sea_state = constants.world.receptor_grid.get_closest_receptor(agent.location).sea_state
         detected = False
 
         # TODO: See if detection is based on RCS or cargo load
@@ -136,10 +136,12 @@ class OTH:
 
         self.scanned_polygon = self.calculate_scanned_polygon(min_range, max_range)
 
+        sea_states = constants.world.receptor_grid.get_sea_states([agent.location for agent in agents_to_check])
+
         located_agents = []
-        for agent in agents_to_check:
+        for agent, sea_state in zip(agents_to_check, sea_states.tolist()):
             self.scanned_polygon.check_if_contains_point(agent.location)
-            if self.detected_agent(agent):
+            if self.detected_agent(agent, sea_state):
                 print(f"Located agent {agent} at ({agent.location.x}, {agent.location.y})")
                 located_agents.append(agent)
         self.located_agents.extend(located_agents)
@@ -19,13 +19,12 @@ unique_point_id = 0
 
 
 class Point:
-    def __init__(self, x: float, y: float, name=None, force_maintain=False, lon_lat=False):
+    def __init__(self, x: float, y: float, name=None, lon_lat=False):
         """
         2-dimensional point.
         :param x:
         :param y:
         :param name:
-        :param force_maintain: Ensures that a point is kept in a convex hull
         :param lon_lat: In case the order is put in as lon/lat, we switch it to get the regular x/y-axis setup.
         """
         global unique_point_id
@@ -42,7 +41,6 @@ class Point:
             self.name = self.point_id
         else:
             self.name = name
-        self.force_maintain = force_maintain
 
     def __str__(self):
         if self.name is None:
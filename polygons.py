@@ -1,9 +1,12 @@
 import matplotlib.axes
 import matplotlib.patches
+import shapely
 import shapely.geometry
+import shapely.prepared
 import numpy as np
 
 from points import Point
+import constants
 import general_maths as gm
 
 # ----------------------------------------------- LOGGER SET UP ------------------------------------------------
@@ -23,15 +26,67 @@ logger.setLevel(logging.DEBUG)
 class Polygon:
     def __init__(self, points: list, color="white", name=None):
         self.name = name
-        self.points = points
+        # Own copy of the point list - the geography is shared by all agents and routes, so neither the list
+        # nor the points are to be changed after creation (apart from order_points, which rebuilds the cache)
+        self.points = list(points)
         self.color = color
 
+        # Cached geometry - built once
+        self.vertices = None
+        self.edges = None
+        self.geometry = None
+        self.prepared_geometry = None
+        self.interior_geometry = None
+        self.bounding_box = None
+        self.fingerprint = None
+        self.update_geometry()
+
     def __str__(self):
         point_text = ""
         for point in self.points:
             point_text = point_text + f"{point}, "
         return f"Polygon with points:" + point_text
 
+    def __getstate__(self) -> dict:
+        # Prepared geometries can not be pickled (or deep-copied), they are rebuilt instead
+        state = self.__dict__.copy()
+        state["prepared_geometry"] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.prepared_geometry = shapely.prepared.prep(self.geometry)
+
+    def update_geometry(self) -> None:
+        """
+        Builds the shapely geometry, prepared geometry, bounding box and vertex arrays of the polygon.
+        The fingerprint is a hash of the coordinates, used to recognise (copies of) the same geography in caches.
+        """
+        coordinates = [(p.x, p.y) for p in self.points]
+        self.vertices = np.array(coordinates, dtype=float).reshape(-1, 2)
+        self.edges = np.stack([self.vertices, np.roll(self.vertices, -1, axis=0)], axis=1)
+
+        if len(coordinates) >= 3:
+            self.geometry = shapely.geometry.Polygon(coordinates)
+        else:
+            self.geometry = shapely.geometry.Polygon()
+        self.prepared_geometry = shapely.prepared.prep(self.geometry)
+        # Slightly shrunk (and repaired) geometry - a line only enters it if it actually passes through the polygon
+        self.interior_geometry = shapely.make_valid(self.geometry).buffer(-constants.ROUTE_VISIBILITY_TOLERANCE)
+        shapely.prepare(self.interior_geometry)
+        # (min_x, min_y, max_x, max_y) - NaN for empty polygons, which then never pass a bounding box check
+        self.bounding_box = self.geometry.bounds
+        self.fingerprint = hash(tuple(coordinates))
+
+    def bounding_box_contains(self, x: float, y: float) -> bool:
+        min_x, min_y, max_x, max_y = self.bounding_box
+        return min_x <= x <= max_x and min_y <= y <= max_y
+
+    def bounding_box_overlaps(self, p_1: Point, p_2: Point) -> bool:
+        min_x, min_y, max_x, max_y = self.bounding_box
+        return (max(p_1.x, p_2.x) >= min_x and min(p_1.x, p_2.x) <= max_x and
+                max(p_1.y, p_2.y) >= min_y and min(p_1.y, p_2.y) <= max_y)
+
     def add_polygon_to_plot(self, axes: matplotlib.axes.Axes, color=None, opacity: float = 1) -> matplotlib.axes.Axes:
         if color is None:
             axes.add_patch(matplotlib.patches.Polygon([(p.x, p.y) for p in self.points],
@@ -51,22 +106,16 @@ class Polygon:
         x = P.x
         y = P.y
 
-        if exclude_edges:
-            for a, b in zip(self.points, self.points[1:] + [self.points[0]]):
-                if gm.is_between_points(a, b, P):
-                    return False
+        if not self.bounding_box_contains(x, y):
+            return False
+
+        if exclude_edges and self.point_is_on_edge(P):
+            return False
 
-        poly_coordinates = [(p.x, p.y) for p in self.points]
-        poly = shapely.geometry.Polygon(poly_coordinates)
-        point = shapely.geometry.Point(x, y)
-        return point.within(poly)
-        # return poly.contains(point)
+        return self.prepared_geometry.contains(shapely.geometry.Point(x, y))
 
     def point_is_on_edge(self, target) -> bool:
-        for a, b in zip(self.points, self.points[1:] + [self.points[0]]):
-            if gm.is_between_points(a, b, target):
-                return True
-        return False
+        return bool(gm.is_between_points_array(self.edges[:, 0], self.edges[:, 1], target).any())
 
     def check_if_line_through_polygon(self, p_1: Point = None, p_2: Point = None, line: list = None) -> bool:
         """
@@ -84,6 +133,10 @@ class Polygon:
             p_1 = line[0]
             p_2 = line[1]
 
+        # ------------------ CASE 0: THE LINE IS NOT NEAR THE POLYGON
+        if not self.bounding_box_overlaps(p_1, p_2):
+            return False
+
         # ------------------ CASE 1.1: A POINT IS IN THE POLYGON
         if self.check_if_contains_point(p_1) or self.check_if_contains_point(p_2):
             # logger.debug(f"LINE CHECK: CASE 1.1")
@@ -147,12 +200,11 @@ class Polygon:
         else:
             # --------------------- CASE 3: THE LINE CROSSES THE POLYGON
             # logger.debug(f"LINE CHECK: CASE 3")
-            for a, b in zip(self.points, self.points[1:] + [self.points[0]]):
-                # logger.debug(f"Checking line from {a} to {b}: {gm.check_if_lines_intersect([a, b], [p_1, p_2])}")
-                # Check if there is any line that the line intersects
-                if gm.check_if_path_and_polygon_intersect([a, b], [p_1, p_2]):
-                    # logger.debug(f"Intersection between line ({a}, {b}) and line ({p_1}, {p_2})")
-                    return True
+            # Check if there is any edge that the line intersects
+            if gm.check_if_paths_and_edges_intersect(np.array([p_1.x, p_1.y]), np.array([p_2.x, p_2.y]),
+                                                     self.edges).any():
+                # logger.debug(f"Line ({p_1}, {p_2}) intersects an edge")
+                return True
 
         # ----------------- CASE 4: WE DO NOT INTERACT WITH THE POLYGON
         # logger.debug(f"LINE CHECK: CASE 4")
@@ -160,20 +212,13 @@ class Polygon:
 
     def check_if_can_connect_edge_points(self, p_1, p_2):
         """
-        Checks if we can connect two points on the edges
+        Checks if we can connect two points on the edges - the line between them may not pass through the polygon
         :param p_1:
         :param p_2:
         :return:
         """
-
-        for lamb in np.arange(0.01, 1, 0.01):
-            if self.check_if_contains_point(
-                    Point(p_1.x * lamb + p_2.x * (1 - lamb), p_1.y * lamb + p_2.y * (1 - lamb))):
-                # logger.debug(f"{Point(p_1.x * lamb + p_2.x * (1 - lamb), p_1.y * lamb + p_2.y * (1 - lamb))} "
-                #              f"is in the polygon")
-                return False
-        # logger.debug(f"{p_1} and {p_2} both in polygon. Does not cross polygon.")
-        return True
+        line = shapely.geometry.LineString([(p_1.x, p_1.y), (p_2.x, p_2.y)])
+        return not self.interior_geometry.intersects(line)
 
     def order_points(self):
         """
@@ -184,3 +229,4 @@ class Polygon:
         self.points.remove(starting_point)
         self.points.sort(key=lambda p: gm.calculate_polar_angle(starting_point, p))
         self.points.insert(0, starting_point)
+        self.update_geometry()
@@ -3,12 +3,11 @@ Receptors track the pheromones for the spread and contain local statistics (e.g.
 """
 import time
 
-import matplotlib.patches
 
 import constants
-import general_maths
 from points import Point
-from general_maths import calculate_distance
+from general_maths import calculate_distances
+from geography import get_polygon_raster
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -25,91 +24,91 @@ logger = logging.getLogger("RECEPTORS")
 logger.setLevel(logging.DEBUG)
 
 
-class Receptor:
-    def __init__(self, x, y, in_polygon=False) -> None:
-        # TODO: Receptors currently only 100 when IN a landmass ->
-        #  change to territorial waters depending on rules (input diff polygon)
-        #  - also finetune value
+def grid_array_property(name: str, decaying=False) -> property:
+    """
+    Property that reads and writes the cell of a receptor in one of the state arrays of its grid
+    :param name: Name of the state array
+    :param decaying: Pheromone arrays are decayed lazily - catch up the cell before it is read or written
+    """
+    def getter(receptor):
+        if decaying:
+            receptor.grid.catch_up(receptor.row, receptor.col)
+        return getattr(receptor.grid, name)[receptor.row, receptor.col]
 
-        if in_polygon:
-            self.alpha_pheromones = 100
-            self.beta_pheromones = 100
-            self.decay = False
-        elif not is_in_area_of_interest(Point(x, y)):
-            self.alpha_pheromones = 100
-            self.beta_pheromones = 100
-            self.decay = False
-        else:
-            self.alpha_pheromones = np.random.uniform(0, 0.1)
-            self.beta_pheromones = np.random.uniform(0, 0.1)
-            self.decay = True
+    def setter(receptor, value):
+        if decaying:
+            receptor.grid.catch_up(receptor.row, receptor.col)
+        getattr(receptor.grid, name)[receptor.row, receptor.col] = value
 
-        # Sea State Variables
-        self.sea_state = 2  # common start sea-state
-        self.last_uniform_value = 0.5  # just to define previous value, expected value of uniform
-        self.new_uniform_value = 0.5
+    return property(getter, setter)
 
-        self.location = Point(x, y)
-        self.in_polygon = in_polygon
 
-        self.patch = None
+class Receptor:
+    """
+    View on a single cell of the receptor grid - the state itself lives in the arrays of the grid.
+    """
+    alpha_pheromones = grid_array_property("alpha_pheromones", decaying=True)
+    beta_pheromones = grid_array_property("beta_pheromones", decaying=True)
+    sea_state = grid_array_property("sea_state")
+    last_uniform_value = grid_array_property("last_uniform_value")
+    new_uniform_value = grid_array_property("new_uniform_value")
+    decay = grid_array_property("decay")
+    in_polygon = grid_array_property("in_polygon")
+
+    def __init__(self, grid, row: int, col: int) -> None:
+        self.grid = grid
+        self.row = row
+        self.col = col
 
     def __str__(self):
         return (f"Receptor at: {self.location} - with alpha: {self.alpha_pheromones}, beta: {self.beta_pheromones},"
                 f"sea state: {self.sea_state}")
 
-    def initiate_plot(self, axes, cmap):
-        if not constants.PLOTTING_MODE:
-            return axes
-
-        if constants.RECEPTOR_PLOT_PARAMETER == "alpha_pheromones":
-            self.patch = matplotlib.patches.Circle((self.location.x, self.location.y),
-                                                   radius=0.05, color=cmap(self.alpha_pheromones / 100),
-                                                   alpha=0.5, linewidth=None)
-        elif constants.RECEPTOR_PLOT_PARAMETER == "beta_pheromones":
-            self.patch = matplotlib.patches.Circle((self.location.x, self.location.y),
-                                                   radius=0.05, color=cmap(self.beta_pheromones / 100),
-                                                   alpha=0.5, linewidth=None)
-        elif constants.RECEPTOR_PLOT_PARAMETER == "sea_states":
-            self.patch = matplotlib.patches.Circle((self.location.x, self.location.y),
-                                                   radius=0.05, color=cmap(self.sea_state / 6),
-                                                   alpha=0.5, linewidth=None)
-        axes.add_patch(self.patch)
-        return axes
-
-    def update_plot(self, axes, cmap):
-        if not constants.PLOTTING_MODE:
-            return
-        if constants.RECEPTOR_PLOT_PARAMETER == "alpha_pheromones":
-            self.patch.set_facecolor(cmap(self.alpha_pheromones / 100))
-            self.patch.set_edgecolor(cmap(self.alpha_pheromones / 100))
-        elif constants.RECEPTOR_PLOT_PARAMETER == "beta_pheromones":
-            self.patch.set_facecolor(cmap(self.beta_pheromones / 100))
-            self.patch.set_edgecolor(cmap(self.beta_pheromones / 100))
-        elif constants.RECEPTOR_PLOT_PARAMETER == "sea_states":
-            self.patch.set_facecolor(cmap(self.sea_state / 6))
-            self.patch.set_edgecolor(cmap(self.sea_state / 6))
-            # self.patch.set_facecolor(cmap(self.new_uniform_value))
-            # self.patch.set_edgecolor(cmap(self.new_uniform_value))
-        return axes
-
-    def in_range_of_point(self, point: Point, radius: float) -> bool:
-        if point.distance_to_point(self.location) <= radius:
-            return True
-        else:
-            return False
+    @property
+    def location(self) -> Point:
+        return Point(float(self.grid.x[self.row, self.col]), float(self.grid.y[self.row, self.col]))
 
 
 class ReceptorGrid:
-    def __init__(self, polygons: list, world) -> None:
-        self.receptors = []
+    """
+    Grid of receptors, of which the state is kept in 2-D arrays indexed by (row, col).
+    Rows run along the x-axis (longitude), columns along the y-axis (latitude).
 
+    Pheromones decay lazily: every time step only increments decay_step, each cell remembers the step up to which
+    it has been decayed and catches up (in closed form) when it is read or deposited on.
+    """
+    def __init__(self, polygons: list, world) -> None:
         self.max_cols = None
         self.max_rows = None
 
+        # State arrays
+        self.x = None
+        self.y = None
+        self.alpha_pheromones = None
+        self.beta_pheromones = None
+        self.sea_state = None
+        self.last_uniform_value = None
+        self.new_uniform_value = None
+        self.decay = None
+        self.in_polygon = None
+
+        # Lazy decay
+        self.decay_step = 0
+        self.last_decay_step = None
+
+        # Deposits queued by the agents, applied in one go by deposit_pheromones
+        self.pending_deposits = []
+
+        # Summed-area tables of the pheromones for the approximate CoP modes, shape (max_rows + 1, max_cols + 1),
+        # rebuilt by the first query of every time step
+        self.summed_alpha_pheromones = None
+        self.summed_beta_pheromones = None
+        self.summed_area_step = None
+
         self.world = world
 
         self.polygons = polygons
+        self.land_raster = get_polygon_raster(polygons)
 
         self.initiate_grid(polygons)
 
@@ -119,6 +118,7 @@ class ReceptorGrid:
             self.cmap = plt.get_cmap("OrRd")
         else:
             self.cmap = plt.get_cmap("Greys")
+        self.scatter = None
 
     def initiate_grid(self, polygons) -> None:
         """
@@ -138,161 +138,445 @@ class ReceptorGrid:
         self.max_cols = int(np.ceil(num_cols))
         self.max_rows = int(np.ceil(num_rows))
 
-        for row in range(self.max_rows):
-            for col in range(self.max_cols):
-                x_location = min_lat + row * constants.GRID_HEIGHT
-                y_location = min_lon + col * constants.GRID_WIDTH
-
-                in_polygon = general_maths.check_if_point_in_polygons(polygons, Point(x_location, y_location),
-                                                                      exclude_edges=False)
-                self.receptors.append(Receptor(x=x_location, y=y_location, in_polygon=in_polygon))
-
-        self.set_up_adjacent_connections()
-
-    def set_up_adjacent_connections(self):
-        for receptor in self.receptors:
-            if is_in_area_of_interest(receptor.location):
-                x, y = receptor.location.x, receptor.location.y
-                receptor.adjacent_N = self.get_receptor_at_location(Point(x, y + constants.GRID_HEIGHT))
-                receptor.adjacent_NE = self.get_receptor_at_location(Point(x + constants.GRID_WIDTH,
-                                                                           y + constants.GRID_HEIGHT))
-                receptor.adjacent_E = self.get_receptor_at_location(Point(x + constants.GRID_WIDTH,
-                                                                          y))
-                receptor.adjacent_SE = self.get_receptor_at_location(Point(x + constants.GRID_WIDTH,
-                                                                           y - constants.GRID_HEIGHT))
-                receptor.adjacent_S = self.get_receptor_at_location(Point(x,
-                                                                          y - constants.GRID_HEIGHT))
-                receptor.adjacent_SW = self.get_receptor_at_location(Point(x - constants.GRID_WIDTH,
-                                                                           y - constants.GRID_HEIGHT))
-                receptor.adjacent_W = self.get_receptor_at_location(Point(x - constants.GRID_WIDTH,
-                                                                          y))
-                receptor.adjacent_NW = self.get_receptor_at_location(Point(x - constants.GRID_WIDTH,
-                                                                           y + constants.GRID_HEIGHT))
-
-    def get_receptor_at_location(self, point: Point) -> Receptor | None:
-        min_lat = constants.MIN_LAT - constants.LAT_GRID_EXTRA
-        max_lat = constants.MAX_LAT + constants.LAT_GRID_EXTRA
-
-        min_lon = constants.MIN_LONG - constants.LONG_GRID_EXTRA
-        max_lon = constants.MAX_LONG + constants.LONG_GRID_EXTRA
+        rows, cols = np.meshgrid(np.arange(self.max_rows), np.arange(self.max_cols), indexing="ij")
+        self.x = (min_lat + rows * constants.GRID_HEIGHT).astype(float)
+        self.y = (min_lon + cols * constants.GRID_WIDTH).astype(float)
 
-        if max_lat < point.x or point.x < min_lat or max_lon < point.y or point.y < min_lon:
-            return None
+        # Receptors are raster cell centres, so this is a lookup in the (cached) land raster
+        self.in_polygon = self.land_raster.contains_points(self.x.ravel(), self.y.ravel(),
+                                                          exclude_edges=False).reshape(self.max_rows, self.max_cols)
 
-        row = int((point.x - min_lat) / constants.GRID_HEIGHT)
-        col = int((point.y - min_lon) / constants.GRID_WIDTH)
-        index = row * self.max_cols + col
+        # TODO: Receptors currently only 100 when IN a landmass ->
+        #  change to territorial waters depending on rules (input diff polygon)
+        #  - also finetune value
+        in_area_of_interest = ((constants.MIN_LAT <= self.x) & (self.x <= constants.MAX_LAT) &
+                               (constants.MIN_LONG <= self.y) & (self.y <= constants.MAX_LONG))
+        self.decay = ~self.in_polygon & in_area_of_interest
+
+        self.alpha_pheromones = np.full((self.max_rows, self.max_cols), 100, dtype=float)
+        self.beta_pheromones = np.full((self.max_rows, self.max_cols), 100, dtype=float)
+        # Drawn as alpha, beta per receptor - in the same order as drawing them receptor by receptor
+        initial_pheromones = np.random.uniform(0, 0.1, size=(int(self.decay.sum()), 2))
+        self.alpha_pheromones[self.decay] = initial_pheromones[:, 0]
+        self.beta_pheromones[self.decay] = initial_pheromones[:, 1]
+        self.last_decay_step = np.zeros((self.max_rows, self.max_cols), dtype=int)
 
-        return self.receptors[index]
+        # Sea State Variables
+        self.sea_state = np.full((self.max_rows, self.max_cols), constants.INITIAL_SEA_STATE, dtype=int)
+        # just to define previous value, expected value of uniform
+        self.last_uniform_value = np.full((self.max_rows, self.max_cols), 0.5)
+        self.new_uniform_value = np.full((self.max_rows, self.max_cols), 0.5)
 
-    def select_receptors_in_radius(self, point: Point, radius: float) -> list:
+    def select_cells_around_points(self, x: np.ndarray, y: np.ndarray,
+                                   radius: float) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
         """
-        Select all the receptors within a radius of a point.
-        Prevents having to cycle through all points by using how the list of receptors was created
-        :param point: Point object
-        :param radius: Radius around the point
-        :return:
+        Select all the cells within a radius of every location.
+        Only the cells in the rectangle around the radius (an upper bound of the coordinate transformation) are
+        checked, every location is compared with the same stencil of cells around it, masked to its rectangle.
+        :param x: Array of x-coordinates of the locations
+        :param y: Array of y-coordinates of the locations
+        :param radius: Radius around the locations
+        :return: Arrays of the location indices, rows, columns and distances (in km) of the selected cells
         """
         t_0 = time.perf_counter()
-        # Adjust radius to an upperbound of the coordinate transformation
+        origin_x = constants.MIN_LAT - constants.LAT_GRID_EXTRA
+        origin_y = constants.MIN_LONG - constants.LONG_GRID_EXTRA
         lon_lat_radius = max(radius / 100, constants.GRID_WIDTH / 2)
-        # only check receptors in the rectangle of size radius - select receptors in the list based on
-        # how the list is constructed.
-        x, y = point.x, point.y
-        min_x = x - lon_lat_radius
-        max_x = x + lon_lat_radius
-        min_y = y - lon_lat_radius
-        max_y = y + lon_lat_radius
-
-        # see in which rows and columns this rectangle is:
-        min_row = int(max(np.floor((min_x - (constants.MIN_LAT - constants.LAT_GRID_EXTRA))
-                                   / constants.GRID_HEIGHT), 0))
-        max_row = int(min(np.ceil((max_x - (constants.MIN_LAT - constants.LAT_GRID_EXTRA))
-                                  / constants.GRID_HEIGHT), self.max_rows))
-
-        min_col = int(max(np.floor((min_y - (constants.MIN_LONG - constants.LONG_GRID_EXTRA))
-                                   / constants.GRID_WIDTH), 0))
-        max_col = int(min(np.ceil((max_y - (constants.MIN_LONG - constants.LONG_GRID_EXTRA))
-                                  / constants.GRID_WIDTH), self.max_cols))
-
-        receptors_in_radius = []
-        for row_index in range(min_row, max_row):
-            for col_index in range(min_col, max_col):
-                index = self.max_cols * row_index + col_index
-                r = self.receptors[index]
-
-                if r.in_range_of_point(point, radius * constants.RECEPTOR_RADIUS_MULTIPLIER):
-                    receptors_in_radius.append(r)
+
+        min_rows = np.maximum(np.floor((x - lon_lat_radius - origin_x) / constants.GRID_HEIGHT), 0).astype(int)
+        max_rows = np.minimum(np.ceil((x + lon_lat_radius - origin_x) / constants.GRID_HEIGHT),
+                              self.max_rows).astype(int)
+        min_cols = np.maximum(np.floor((y - lon_lat_radius - origin_y) / constants.GRID_WIDTH), 0).astype(int)
+        max_cols = np.minimum(np.ceil((y + lon_lat_radius - origin_y) / constants.GRID_WIDTH),
+                              self.max_cols).astype(int)
+
+        # Stencil of (location, row offset, column offset), large enough for the widest rectangle
+        row_offsets = np.arange(max(int(np.max(max_rows - min_rows, initial=0)), 0))
+        col_offsets = np.arange(max(int(np.max(max_cols - min_cols, initial=0)), 0))
+        rows = (min_rows[:, None] + row_offsets[None, :])[:, :, None]
+        cols = (min_cols[:, None] + col_offsets[None, :])[:, None, :]
+        in_rectangle = (rows < max_rows[:, None, None]) & (cols < max_cols[:, None, None])
+        rows = np.minimum(rows, self.max_rows - 1)
+        cols = np.minimum(cols, self.max_cols - 1)
+
+        distances = calculate_distances(x[:, None, None], y[:, None, None], self.x[rows, cols], self.y[rows, cols])
+        selected = in_rectangle & (distances <= radius * constants.RECEPTOR_RADIUS_MULTIPLIER)
+        location_indices, row_indices, col_indices = np.nonzero(selected)
 
         t_1 = time.perf_counter()
         constants.time_spent_selecting_receptors += (t_1 - t_0)
-        return receptors_in_radius
+        return (location_indices, rows[location_indices, row_indices, 0], cols[location_indices, 0, col_indices],
+                distances[selected])
+
+    def get_closest_cells(self, x, y) -> (np.ndarray, np.ndarray):
+        """
+        Nearest cells of an array of locations - the grid is regular, so this is a matter of rounding.
+        Locations off the grid get the nearest cell on its edge.
+        :param x: Array of x-coordinates
+        :param y: Array of y-coordinates
+        :return: Arrays of the rows and columns
+        """
+        min_lat = constants.MIN_LAT - constants.LAT_GRID_EXTRA
+        min_lon = constants.MIN_LONG - constants.LONG_GRID_EXTRA
+        rows = np.floor((np.asarray(x, dtype=float) - min_lat) / constants.GRID_HEIGHT + 0.5).astype(int)
+        cols = np.floor((np.asarray(y, dtype=float) - min_lon) / constants.GRID_WIDTH + 0.5).astype(int)
+        return np.clip(rows, 0, self.max_rows - 1), np.clip(cols, 0, self.max_cols - 1)
 
     def get_closest_receptor(self, point: Point) -> Receptor:
-        h_space_between_receptors = constants.GRID_WIDTH
-        v_space_between_receptors = constants.GRID_HEIGHT
+        # Scalar version of get_closest_cells
+        row = math.floor((point.x - (constants.MIN_LAT - constants.LAT_GRID_EXTRA)) / constants.GRID_HEIGHT + 0.5)
+        col = math.floor((point.y - (constants.MIN_LONG - constants.LONG_GRID_EXTRA)) / constants.GRID_WIDTH + 0.5)
+        return Receptor(self, min(max(row, 0), self.max_rows - 1), min(max(col, 0), self.max_cols - 1))
 
-        radius = max(h_space_between_receptors, v_space_between_receptors)
+    def get_sea_states(self, points: list) -> np.ndarray:
+        """
+        Sea states at the closest receptors of a list of points
+        :param points: List of Point objects
+        :return: Integer array of sea states
+        """
+        rows, cols = self.get_closest_cells([point.x for point in points], [point.y for point in points])
+        return self.sea_state[rows, cols]
 
-        potential_receptors = self.select_receptors_in_radius(point, radius * constants.LATITUDE_CONVERSION_FACTOR)
-        dist = math.inf
+    def depreciate_pheromones(self):
+        """
+        Advance the pheromone decay by one time step - applied to the cells once they are used
+        """
+        self.decay_step += 1
 
-        selected_receptor = None
+    def catch_up(self, rows, cols) -> None:
+        """
+        Apply the decay of the time steps since the cells were last decayed
+        :param rows: Row index or array of row indices
+        :param cols: Column index or array of column indices
+        """
+        # Queued deposits land before the cells are read
+        if self.pending_deposits:
+            self.deposit_pheromones()
 
-        for receptor in potential_receptors:
-            distance_to_receptor = receptor.location.distance_to_point(point)
-            if distance_to_receptor < dist:
-                dist = distance_to_receptor
-                selected_receptor = receptor
+        steps = self.decay_step - self.last_decay_step[rows, cols]
+        if np.all(steps == 0):
+            return
+        factor = constants.PHEROMONE_DEPRECIATION_FACTOR_PER_TIME_DELTA ** (1 / self.world.time_delta)
+        decay_factor = np.where(self.decay[rows, cols], factor ** steps, 1)
+        self.alpha_pheromones[rows, cols] *= decay_factor
+        self.beta_pheromones[rows, cols] *= decay_factor
+        self.last_decay_step[rows, cols] = self.decay_step
 
-        if selected_receptor is None:
-            print(f"{potential_receptors=}, {selected_receptor=}, {dist=}")
-            point.add_point_to_plot(constants.axes_plot, color="purple")
-            radius_patch = matplotlib.patches.Circle((point.x, point.y),
-                                                     radius=radius,
-                                                     color="purple", alpha=0.1, linewidth=None)
-            constants.axes_plot.add_patch(radius_patch)
-            raise ValueError(f"Failed to find suitable receptor at {point} - {radius=} - {point.x, point.y}.")
+    def materialize(self) -> None:
+        """
+        Bring the pheromones of the full grid up to date (for plots and snapshots)
+        """
+        self.catch_up(slice(None), slice(None))
 
-        return selected_receptor
+    def queue_deposits(self, x: np.ndarray, y: np.ndarray, radius: float, amount: float,
+                       pheromone_type="beta") -> None:
+        """
+        Queue the pheromones spread from a series of locations (e.g. the points along the path of an agent),
+        they are applied together with the deposits of the other agents by deposit_pheromones.
+        Every location deposits on the decaying receptors in the radius, inversely proportional to the distance.
+        :param x: Array of x-coordinates of the locations
+        :param y: Array of y-coordinates of the locations
+        :param radius: Radius around the locations
+        :param amount: Pheromones deposited per location on a receptor at (at most) 0.1 km
+        :param pheromone_type: Type of pheromone (Taiwan is alpha pheromones, China is beta pheromones)
+        """
+        if pheromone_type not in ["alpha", "beta"]:
+            return
+        self.pending_deposits.append((np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+                                      radius, amount, pheromone_type))
 
-    def depreciate_pheromones(self):
-        for receptor in self.receptors:
-            if receptor.decay:
-                receptor.alpha_pheromones = (receptor.alpha_pheromones *
-                                             constants.PHEROMONE_DEPRECIATION_FACTOR_PER_TIME_DELTA
-                                             ** (1 / self.world.time_delta))
-                receptor.beta_pheromones = (receptor.beta_pheromones *
-                                            constants.PHEROMONE_DEPRECIATION_FACTOR_PER_TIME_DELTA
-                                            ** (1 / self.world.time_delta))
-
-    def calculate_CoP(self, point: Point, radius: float, pheromone_type="beta") -> (float, list):
+    def deposit_pheromones(self) -> None:
         """
-        Calculates the concentration of pheromones
-        :param point:
+        Apply all queued deposits in one vectorized update
+        """
+        if not self.pending_deposits:
+            return
+        deposits = self.pending_deposits
+        self.pending_deposits = []
+
+        x = np.concatenate([deposit[0] for deposit in deposits])
+        y = np.concatenate([deposit[1] for deposit in deposits])
+        sizes = [len(deposit[0]) for deposit in deposits]
+        radii = np.repeat([deposit[2] for deposit in deposits], sizes)
+        amounts = np.repeat([deposit[3] for deposit in deposits], sizes)
+        is_alpha = np.repeat([deposit[4] == "alpha" for deposit in deposits], sizes)
+
+        touched_rows = []
+        touched_cols = []
+        touched_deposits = []
+        touched_alpha = []
+        for radius in np.unique(radii):
+            group = np.flatnonzero(radii == radius)
+            location_indices, rows, cols, distances = self.select_cells_around_points(x[group], y[group], radius)
+            decaying = self.decay[rows, cols]
+            location_indices = group[location_indices[decaying]]
+            touched_rows.append(rows[decaying])
+            touched_cols.append(cols[decaying])
+            touched_deposits.append((1 / np.maximum(distances[decaying], 0.1)) * amounts[location_indices])
+            touched_alpha.append(is_alpha[location_indices])
+
+        rows = np.concatenate(touched_rows)
+        cols = np.concatenate(touched_cols)
+        deposit = np.concatenate(touched_deposits)
+        alpha = np.concatenate(touched_alpha)
+
+        cells = np.unique(rows * self.max_cols + cols)
+        self.catch_up(cells // self.max_cols, cells % self.max_cols)
+        np.add.at(self.alpha_pheromones, (rows[alpha], cols[alpha]), deposit[alpha])
+        np.add.at(self.beta_pheromones, (rows[~alpha], cols[~alpha]), deposit[~alpha])
+
+    def calculate_CoP_batch(self, points: list, radius: float, pheromone_type="beta") -> np.ndarray:
+        """
+        Calculates the concentration of pheromones at a number of candidate points at once
+        :param points: List of Point objects
         :param radius:
         :param pheromone_type: Type of pheromone (Taiwan is alpha pheromones, China is beta pheromones)
-        :return:
+        :return: Array with the CoP of every point, infinite outside the area of interest and on land
         """
+        x = np.array([point.x for point in points], dtype=float)
+        y = np.array([point.y for point in points], dtype=float)
+        CoP = np.zeros(len(points))
+
+        in_area_of_interest = ((constants.MIN_LAT <= x) & (x <= constants.MAX_LAT) &
+                               (constants.MIN_LONG <= y) & (y <= constants.MAX_LONG))
+        CoP[~in_area_of_interest] = math.inf
+        candidates = np.flatnonzero(in_area_of_interest)
+        on_land = self.land_raster.contains_points(x[candidates], y[candidates], exclude_edges=False)
+        CoP[candidates[on_land]] = math.inf
+        candidates = candidates[~on_land]
+
+        if constants.COP_MODE == "summed_area":
+            CoP[candidates] = self.calculate_CoP_summed_area(x[candidates], y[candidates], radius, pheromone_type)
+            return CoP
+        elif constants.COP_MODE == "pyramid" and self.select_pyramid_level(radius) > 0:
+            CoP[candidates] = self.calculate_CoP_pyramid(x[candidates], y[candidates], radius, pheromone_type)
+            return CoP
+        elif constants.COP_MODE not in ["exact", "pyramid"]:
+            raise ValueError(f"Unknown CoP mode {constants.COP_MODE}")
+
         # Increase radius of receptors selected by a factor 2 to make more future-proof decisions
-        receptors = self.select_receptors_in_radius(point, radius * 2)
+        location_indices, rows, cols, distances = self.select_cells_around_points(x[candidates], y[candidates],
+                                                                                  radius * 2)
+        self.catch_up(rows, cols)
+        if pheromone_type == "alpha":
+            pheromones = self.alpha_pheromones[rows, cols]
+        elif pheromone_type == "beta":
+            pheromones = self.beta_pheromones[rows, cols]
+        else:
+            return CoP
+        CoP[candidates] = np.bincount(location_indices, weights=pheromones / np.maximum(0.1, distances),
+                                      minlength=len(candidates))
+        return CoP
+
+    def update_summed_area_tables(self) -> None:
+        """
+        Rebuild the summed-area tables of the pheromones - brings the full grid up to date
+        """
+        self.materialize()
+        self.summed_area_step = self.decay_step
+        self.summed_alpha_pheromones = np.zeros((self.max_rows + 1, self.max_cols + 1))
+        self.summed_alpha_pheromones[1:, 1:] = self.alpha_pheromones.cumsum(axis=0).cumsum(axis=1)
+        self.summed_beta_pheromones = np.zeros((self.max_rows + 1, self.max_cols + 1))
+        self.summed_beta_pheromones[1:, 1:] = self.beta_pheromones.cumsum(axis=0).cumsum(axis=1)
+
+    def calculate_CoP_summed_area(self, x: np.ndarray, y: np.ndarray, radius: float,
+                                  pheromone_type="beta") -> np.ndarray:
+        """
+        Approximate CoP of an array of points in a fixed number of operations per point.
+        The four receptors surrounding a point are weighted exactly, the rest of the rectangle that
+        select_cells_around_points checks is divided into COP_SUMMED_AREA_RINGS square rings around them. The pheromones
+        of a ring follow from the summed-area table and are weighted by the inverse of a representative distance.
+        :param x: Array of x-coordinates
+        :param y: Array of y-coordinates
+        :param radius:
+        :param pheromone_type: Type of pheromone (Taiwan is alpha pheromones, China is beta pheromones)
+        :return: Array with the approximate CoP of every point
+        """
+        if self.summed_area_step != self.decay_step:
+            self.update_summed_area_tables()
 
-        if not is_in_area_of_interest(point):
-            return math.inf, receptors
+        if pheromone_type == "alpha":
+            table, pheromones = self.summed_alpha_pheromones, self.alpha_pheromones
+        elif pheromone_type == "beta":
+            table, pheromones = self.summed_beta_pheromones, self.beta_pheromones
+        else:
+            return np.zeros(len(x))
 
-        for polygon in self.polygons:
-            if polygon.check_if_contains_point(point, exclude_edges=False):
-                return math.inf, receptors
+        def box_sums(min_rows, max_rows, min_cols, max_cols):
+            return (table[max_rows, max_cols] - table[min_rows, max_cols]
+                    - table[max_rows, min_cols] + table[min_rows, min_cols])
+
+        origin_x = constants.MIN_LAT - constants.LAT_GRID_EXTRA
+        origin_y = constants.MIN_LONG - constants.LONG_GRID_EXTRA
+        # Increase radius of receptors selected by a factor 2 to make more future-proof decisions
+        lon_lat_radius = max(radius * 2 / 100, constants.GRID_WIDTH / 2)
+        min_rows = np.maximum(np.floor((x - lon_lat_radius - origin_x) / constants.GRID_HEIGHT), 0).astype(int)
+        max_rows = np.minimum(np.ceil((x + lon_lat_radius - origin_x) / constants.GRID_HEIGHT),
+                              self.max_rows).astype(int)
+        min_cols = np.maximum(np.floor((y - lon_lat_radius - origin_y) / constants.GRID_WIDTH), 0).astype(int)
+        max_cols = np.minimum(np.ceil((y + lon_lat_radius - origin_y) / constants.GRID_WIDTH),
+                              self.max_cols).astype(int)
+
+        # Exact contribution of the (up to) four surrounding receptors
+        first_rows = np.floor((x - origin_x) / constants.GRID_HEIGHT).astype(int)
+        first_cols = np.floor((y - origin_y) / constants.GRID_WIDTH).astype(int)
+        CoP = np.zeros(len(x))
+        for row_offset, col_offset in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+            rows = first_rows + row_offset
+            cols = first_cols + col_offset
+            selected = (min_rows <= rows) & (rows < max_rows) & (min_cols <= cols) & (cols < max_cols)
+            rows, cols = rows[selected], cols[selected]
+            self.catch_up(rows, cols)
+            distances = calculate_distances(x[selected], y[selected], self.x[rows, cols], self.y[rows, cols])
+            CoP[selected] += pheromones[rows, cols] / np.maximum(0.1, distances)
+
+        # Rings of `ring_width` receptors around the four surrounding receptors, clipped to the rectangle
+        reach = np.maximum.reduce([first_rows - min_rows, max_rows - first_rows - 2,
+                                   first_cols - min_cols, max_cols - first_cols - 2, np.zeros(len(x), dtype=int)])
+        ring_width = np.maximum(np.ceil(reach / constants.COP_SUMMED_AREA_RINGS), 1).astype(int)
+        # km per receptor spacing, averaged over both directions
+        receptor_spacing = np.sqrt(constants.LATITUDE_CONVERSION_FACTOR * constants.GRID_WIDTH *
+                                   constants.LONGITUDE_CONVERSION_FACTOR * constants.GRID_HEIGHT *
+                                   np.cos(np.radians(y)))
+
+        inner_sums = box_sums(np.clip(first_rows, min_rows, max_rows), np.clip(first_rows + 2, min_rows, max_rows),
+                              np.clip(first_cols, min_cols, max_cols), np.clip(first_cols + 2, min_cols, max_cols))
+        for ring in range(1, constants.COP_SUMMED_AREA_RINGS + 1):
+            extent = ring * ring_width
+            outer_sums = box_sums(np.clip(first_rows - extent, min_rows, max_rows),
+                                  np.clip(first_rows + 2 + extent, min_rows, max_rows),
+                                  np.clip(first_cols - extent, min_cols, max_cols),
+                                  np.clip(first_cols + 2 + extent, min_cols, max_cols))
+            # Mean distance to the receptors of a square ring is about 1.15 times its half-width
+            ring_distance = 1.15 * ((ring - 0.5) * ring_width + 1) * receptor_spacing
+            CoP += (outer_sums - inner_sums) / ring_distance
+            inner_sums = outer_sums
+        return CoP
+
+    def select_pyramid_level(self, radius: float) -> int:
+        """
+        Coarsest level of the pheromone pyramid that has COP_PYRAMID_CELLS_PER_RADIUS blocks within the radius
+        """
+        lon_lat_radius = max(radius * 2 / 100, constants.GRID_WIDTH / 2)
+        blocks = lon_lat_radius / (max(constants.GRID_WIDTH, constants.GRID_HEIGHT) *
+                                   constants.COP_PYRAMID_CELLS_PER_RADIUS)
+        if blocks < 2:
+            return 0
+        max_level = int(np.ceil(np.log2(max(self.max_rows, self.max_cols))))
+        return min(int(np.floor(np.log2(blocks))), max_level)
+
+    def calculate_CoP_pyramid(self, x: np.ndarray, y: np.ndarray, radius: float,
+                              pheromone_type="beta") -> np.ndarray:
+        """
+        Approximate CoP of an array of points, summed over square blocks of receptors rather than receptors.
+        The block size is the coarsest level of the pyramid (blocks of 2^level receptors) that suits the radius.
+        The receptors in the 3x3 blocks around a point are weighted exactly. The other blocks are clipped to the
+        rectangle that select_cells_around_points checks, their pheromones follow from the summed-area table and are
+        weighted by the inverse distance to the centre of the clipped block.
+        :param x: Array of x-coordinates
+        :param y: Array of y-coordinates
+        :param radius:
+        :param pheromone_type: Type of pheromone (Taiwan is alpha pheromones, China is beta pheromones)
+        :return: Array with the approximate CoP of every point
+        """
+        if self.summed_area_step != self.decay_step:
+            self.update_summed_area_tables()
 
-        CoP = 0
         if pheromone_type == "alpha":
-            for receptor in receptors:
-                CoP += (1 / max(0.1, calculate_distance(a=point, b=receptor.location))) * receptor.alpha_pheromones
+            table, pheromones = self.summed_alpha_pheromones, self.alpha_pheromones
         elif pheromone_type == "beta":
-            for receptor in receptors:
-                CoP += (1 / max(0.1, calculate_distance(a=point, b=receptor.location))) * receptor.beta_pheromones
-        # logger.debug(f"Calculated CoP at {point} with rad {radius}: {CoP} - from {len(receptors)} receptors.")
-        return CoP, receptors
+            table, pheromones = self.summed_beta_pheromones, self.beta_pheromones
+        else:
+            return np.zeros(len(x))
+        block_size = 2 ** self.select_pyramid_level(radius)
+
+        origin_x = constants.MIN_LAT - constants.LAT_GRID_EXTRA
+        origin_y = constants.MIN_LONG - constants.LONG_GRID_EXTRA
+        # Increase radius of receptors selected by a factor 2 to make more future-proof decisions
+        lon_lat_radius = max(radius * 2 / 100, constants.GRID_WIDTH / 2)
+        min_rows = np.maximum(np.floor((x - lon_lat_radius - origin_x) / constants.GRID_HEIGHT), 0).astype(int)
+        max_rows = np.minimum(np.ceil((x + lon_lat_radius - origin_x) / constants.GRID_HEIGHT),
+                              self.max_rows).astype(int)
+        min_cols = np.maximum(np.floor((y - lon_lat_radius - origin_y) / constants.GRID_WIDTH), 0).astype(int)
+        max_cols = np.minimum(np.ceil((y + lon_lat_radius - origin_y) / constants.GRID_WIDTH),
+                              self.max_cols).astype(int)
+        own_rows = np.clip(np.floor((x - origin_x) / constants.GRID_HEIGHT).astype(int), 0, self.max_rows - 1)
+        own_rows //= block_size
+        own_cols = np.clip(np.floor((y - origin_y) / constants.GRID_WIDTH).astype(int), 0, self.max_cols - 1)
+        own_cols //= block_size
+
+        # Exact contribution of the receptors in the surrounding blocks
+        CoP = np.zeros(len(x))
+        offsets = np.arange(-block_size, 2 * block_size)
+        rows = (own_rows[:, None] * block_size + offsets[None, :])[:, :, None]
+        cols = (own_cols[:, None] * block_size + offsets[None, :])[:, None, :]
+        selected = ((min_rows[:, None, None] <= rows) & (rows < max_rows[:, None, None]) &
+                    (min_cols[:, None, None] <= cols) & (cols < max_cols[:, None, None]))
+        location_indices, row_indices, col_indices = np.nonzero(selected)
+        rows = rows[location_indices, row_indices, 0]
+        cols = cols[location_indices, 0, col_indices]
+        self.catch_up(rows, cols)
+        distances = calculate_distances(x[location_indices], y[location_indices], self.x[rows, cols],
+                                        self.y[rows, cols])
+        CoP += np.bincount(location_indices, weights=pheromones[rows, cols] / np.maximum(0.1, distances),
+                           minlength=len(x))
+
+        # Other blocks overlapping the rectangle, clipped to it
+        min_block_rows = min_rows // block_size
+        min_block_cols = min_cols // block_size
+        row_offsets = np.arange(int(np.max((max_rows - 1) // block_size - min_block_rows, initial=-1)) + 1)
+        col_offsets = np.arange(int(np.max((max_cols - 1) // block_size - min_block_cols, initial=-1)) + 1)
+        block_rows = (min_block_rows[:, None] + row_offsets[None, :])[:, :, None]
+        block_cols = (min_block_cols[:, None] + col_offsets[None, :])[:, None, :]
+        first_rows = np.maximum(block_rows * block_size, min_rows[:, None, None])
+        last_rows = np.minimum((block_rows + 1) * block_size, max_rows[:, None, None])
+        first_cols = np.maximum(block_cols * block_size, min_cols[:, None, None])
+        last_cols = np.minimum((block_cols + 1) * block_size, max_cols[:, None, None])
+        selected = ((first_rows < last_rows) & (first_cols < last_cols) &
+                    ((np.abs(block_rows - own_rows[:, None, None]) > 1) |
+                     (np.abs(block_cols - own_cols[:, None, None]) > 1)))
+        location_indices, row_indices, col_indices = np.nonzero(selected)
+        first_rows = first_rows[location_indices, row_indices, 0]
+        last_rows = last_rows[location_indices, row_indices, 0]
+        first_cols = first_cols[location_indices, 0, col_indices]
+        last_cols = last_cols[location_indices, 0, col_indices]
+        sums = (table[last_rows, last_cols] - table[first_rows, last_cols]
+                - table[last_rows, first_cols] + table[first_rows, first_cols])
+        distances = calculate_distances(x[location_indices], y[location_indices],
+                                        origin_x + (first_rows + last_rows - 1) / 2 * constants.GRID_HEIGHT,
+                                        origin_y + (first_cols + last_cols - 1) / 2 * constants.GRID_WIDTH)
+        CoP += np.bincount(location_indices, weights=sums / np.maximum(0.1, distances), minlength=len(x))
+        return CoP
+
+    def plot_colors(self) -> np.ndarray:
+        if constants.RECEPTOR_PLOT_PARAMETER in ["alpha_pheromones", "beta_pheromones"]:
+            self.materialize()
+
+        if constants.RECEPTOR_PLOT_PARAMETER == "alpha_pheromones":
+            values = self.alpha_pheromones / 100
+        elif constants.RECEPTOR_PLOT_PARAMETER == "beta_pheromones":
+            values = self.beta_pheromones / 100
+        elif constants.RECEPTOR_PLOT_PARAMETER == "sea_states":
+            values = self.sea_state / 6
+        else:
+            values = np.zeros((self.max_rows, self.max_cols))
+        return self.cmap(values.ravel())
+
+    def initiate_plot(self, axes):
+        """
+        Plots all receptors as a single scatter collection
+        """
+        if not constants.PLOTTING_MODE:
+            return axes
+
+        self.scatter = axes.scatter(self.x.ravel(), self.y.ravel(), s=4, c=self.plot_colors(), alpha=0.5,
+                                    linewidths=0)
+        return axes
+
+    def update_plot(self):
+        if not constants.PLOTTING_MODE or self.scatter is None:
+            return
+        self.scatter.set_facecolor(self.plot_colors())
 
 
 def is_in_area_of_interest(point: Point) -> bool:
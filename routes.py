@@ -1,9 +1,15 @@
 import copy
+import heapq
+from collections import OrderedDict
+import math
 import time
 import warnings
 import matplotlib.axes
+import numpy as np
+import shapely
 from points import Point
 from polygons import Polygon
+from geography import get_geography_index
 
 import constants
 import general_maths as gm
@@ -47,19 +53,298 @@ class Route:
         return lines
 
 
-def create_route(point_a: Point, point_b: Point, polygons_to_avoid: list) -> Route:
+class VisibilityGraph:
+    """
+    Graph of all obstacle vertices that can be travelled between in a straight line.
+    Only convex vertices are used as nodes, as shortest paths around obstacles only bend at those.
+    The graph is built once for a set of obstacles, routes are found by connecting the start and end point
+    to the graph and running A*.
+    """
+    def __init__(self, polygons: list):
+        self.polygons = polygons
+
+        self.obstacle_geometry = None
+        self.nodes = []
+        self.node_x = None
+        self.node_y = None
+        self.max_latitude = 0
+        self.adjacency = []
+
+        self.build_graph()
+
+    def build_graph(self) -> None:
+        t_0 = time.perf_counter()
+
+        # Shrink the obstacles slightly so that paths along the coastline and through vertices are not obstructed
+        interiors = [shapely.make_valid(polygon.geometry).buffer(-constants.ROUTE_VISIBILITY_TOLERANCE)
+                     for polygon in self.polygons if not polygon.geometry.is_empty]
+        self.obstacle_geometry = shapely.union_all(interiors)
+        shapely.prepare(self.obstacle_geometry)
+
+        for polygon in self.polygons:
+            self.nodes.extend(select_convex_points(polygon))
+
+        self.node_x = np.array([p.x for p in self.nodes])
+        self.node_y = np.array([p.y for p in self.nodes])
+
+        # Vertices inside other obstacles can never be reached
+        reachable = ~shapely.contains_xy(self.obstacle_geometry, self.node_x, self.node_y)
+        self.nodes = [p for p, r in zip(self.nodes, reachable) if r]
+        self.node_x = self.node_x[reachable]
+        self.node_y = self.node_y[reachable]
+        self.max_latitude = float(np.max(np.abs(self.node_y), initial=0))
+
+        self.adjacency = [[] for _ in self.nodes]
+        index_a, index_b = np.triu_indices(len(self.nodes), k=1)
+        visible = self.check_if_visible(self.node_x[index_a], self.node_y[index_a],
+                                        self.node_x[index_b], self.node_y[index_b])
+        index_a = index_a[visible]
+        index_b = index_b[visible]
+        distances = gm.calculate_distances(self.node_x[index_a], self.node_y[index_a],
+                                           self.node_x[index_b], self.node_y[index_b])
+        for a, b, distance in zip(index_a.tolist(), index_b.tolist(), distances.tolist()):
+            self.adjacency[a].append((b, distance))
+            self.adjacency[b].append((a, distance))
+
+        t_1 = time.perf_counter()
+        logger.debug(f"Built visibility graph with {len(self.nodes)} nodes and {len(index_a)} edges "
+                     f"in {t_1 - t_0: .3f}s")
+
+    def check_if_visible(self, x_a, y_a, x_b, y_b) -> np.ndarray:
+        """
+        Vectorized check if the straight lines from a to b do not pass through any obstacle
+        :return: Boolean array, True if the line is unobstructed
+        """
+        start = np.stack(np.broadcast_arrays(x_a, y_a), axis=-1)
+        end = np.stack(np.broadcast_arrays(x_b, y_b), axis=-1)
+        lines = shapely.linestrings(np.stack(np.broadcast_arrays(start, end), axis=-2))
+        return ~shapely.intersects(lines, self.obstacle_geometry)
+
+    def is_visible(self, p_1: Point, p_2: Point) -> bool:
+        return bool(self.check_if_visible(p_1.x, p_1.y, p_2.x, p_2.y))
+
+    def find_path(self, point_a: Point, point_b: Point) -> list:
+        """
+        A* search from point a to point b over the visibility graph
+        :param point_a: Start Point
+        :param point_b: End Point
+        :return: List of points from a to b
+        """
+        if self.is_visible(point_a, point_b):
+            return [point_a, point_b]
+
+        visible_from_a = np.flatnonzero(self.check_if_visible(point_a.x, point_a.y, self.node_x, self.node_y))
+        visible_from_b = np.flatnonzero(self.check_if_visible(point_b.x, point_b.y, self.node_x, self.node_y))
+
+        if len(visible_from_a) == 0 or len(visible_from_b) == 0:
+            raise ValueError(f"Unable to create route from {point_a} at ({point_a.x}, {point_a.y}) to {point_b} at "
+                             f"({point_b.x}, {point_b.y}) - no obstacle vertex can be reached.")
+
+        distance_to_b = gm.calculate_distances(self.node_x, self.node_y, point_b.x, point_b.y)
+        start_distances = gm.calculate_distances(self.node_x[visible_from_a], self.node_y[visible_from_a],
+                                                 point_a.x, point_a.y)
+        final_legs = dict(zip(visible_from_b.tolist(), distance_to_b[visible_from_b].tolist()))
+        # The straight-line distance is no lower bound on the route length, as the lengths of legs do not add up
+        max_latitude = max(self.max_latitude, abs(point_a.y), abs(point_b.y))
+        heuristic = gm.calculate_lower_bound_distances(self.node_x, self.node_y, point_b.x, point_b.y,
+                                                       max_latitude).tolist()
+
+        # Goal is represented by index -1
+        costs = {}
+        previous = {}
+        queue = []
+        for node, distance in zip(visible_from_a.tolist(), start_distances.tolist()):
+            costs[node] = distance
+            previous[node] = None
+            heapq.heappush(queue, (distance + heuristic[node], distance, node))
+
+        while queue:
+            _, cost, node = heapq.heappop(queue)
+            if node == -1:
+                break
+            if cost > costs[node]:
+                continue
+
+            if node in final_legs:
+                goal_cost = cost + final_legs[node]
+                if goal_cost < costs.get(-1, math.inf):
+                    costs[-1] = goal_cost
+                    previous[-1] = node
+                    heapq.heappush(queue, (goal_cost, goal_cost, -1))
+
+            for neighbour, distance in self.adjacency[node]:
+                new_cost = cost + distance
+                if new_cost < costs.get(neighbour, math.inf):
+                    costs[neighbour] = new_cost
+                    previous[neighbour] = node
+                    heapq.heappush(queue, (new_cost + heuristic[neighbour], new_cost, neighbour))
+
+        if -1 not in previous:
+            raise ValueError(f"Unable to create route from {point_a} at ({point_a.x}, {point_a.y}) to {point_b} at "
+                             f"({point_b.x}, {point_b.y}) - no connection through the visibility graph.")
+
+        path = [point_b]
+        node = previous[-1]
+        while node is not None:
+            path.append(self.nodes[node])
+            node = previous[node]
+        path.append(point_a)
+        path.reverse()
+        return path
+
+
+visibility_graphs = {}
+
+
+def get_visibility_graph(polygons: list) -> VisibilityGraph:
+    """
+    Returns the visibility graph for a set of obstacles, builds it if it does not exist yet
+    :param polygons: List of polygons to avoid
+    :return:
+    """
+    key = tuple(polygon.fingerprint for polygon in polygons)
+    if key not in visibility_graphs:
+        visibility_graphs[key] = VisibilityGraph(polygons)
+    return visibility_graphs[key]
+
+
+class RouteCache:
+    """
+    Least-recently-used cache of routes.
+    Routes are keyed by their endpoints snapped to a grid of the tolerance, the planner and the obstacles avoided.
+    A cached route is reused between the exact endpoints requested, after re-checking its first and last leg.
+    """
+    def __init__(self, size: int, tolerance: float):
+        self.size = size
+        self.tolerance = tolerance
+        self.routes = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.routes)
+
+    def make_key(self, point_a: Point, point_b: Point, polygons_to_avoid: list) -> tuple:
+        return (round(point_a.x / self.tolerance), round(point_a.y / self.tolerance),
+                round(point_b.x / self.tolerance), round(point_b.y / self.tolerance),
+                constants.ROUTE_PLANNER, tuple(polygon.fingerprint for polygon in polygons_to_avoid))
+
+    def get(self, point_a: Point, point_b: Point, polygons_to_avoid: list) -> list | None:
+        """
+        Look up a route between (nearly) the same endpoints
+        :param point_a: Start Point
+        :param point_b: End Point
+        :param polygons_to_avoid: List of polygons to avoid
+        :return: List of points from a to b, or None if no usable route is cached
+        """
+        key = self.make_key(point_a, point_b, polygons_to_avoid)
+        cached_route = self.routes.get(key)
+        if cached_route is not None:
+            # Swap in the exact endpoints, the legs to and from the intermediate points may now be obstructed
+            route = [point_a] + cached_route[1:-1] + [point_b]
+            if (leg_is_clear(route[0], route[1], polygons_to_avoid) and
+                    leg_is_clear(route[-2], route[-1], polygons_to_avoid)):
+                self.routes.move_to_end(key)
+                self.hits += 1
+                return route
+
+        self.misses += 1
+        return None
+
+    def put(self, point_a: Point, point_b: Point, polygons_to_avoid: list, route: list) -> None:
+        if self.size <= 0:
+            return
+        key = self.make_key(point_a, point_b, polygons_to_avoid)
+        self.routes[key] = list(route)
+        self.routes.move_to_end(key)
+        if len(self.routes) > self.size:
+            self.routes.popitem(last=False)
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0
+
+    def clear(self) -> None:
+        self.routes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+route_cache = RouteCache(size=constants.ROUTE_CACHE_SIZE, tolerance=constants.ROUTE_CACHE_TOLERANCE)
+
+
+def leg_is_clear(p_1: Point, p_2: Point, polygons_to_avoid: list) -> bool:
+    """
+    Check if the straight line from p_1 to p_2 avoids the polygons, using the active route planner's definition
+    """
+    if constants.ROUTE_PLANNER == "visibility_graph":
+        return get_visibility_graph(polygons_to_avoid).is_visible(p_1, p_2)
+    else:
+        return not line_crosses_any_polygon(polygons_to_avoid, [p_1, p_2])[0]
+
+
+def select_convex_points(polygon: Polygon) -> list:
+    """
+    Selects the vertices of a polygon where the polygon is convex - the only vertices a shortest path can bend around.
+    For invalid (self-intersecting) polygons the orientation is ambiguous, so all vertices are returned.
+    :param polygon:
+    :return:
+    """
+    points = polygon.points
+    if polygon.geometry.is_empty:
+        return []
+    if not polygon.geometry.is_valid:
+        return list(points)
+
+    orientation = 1 if polygon.geometry.exterior.is_ccw else -1
+    convex_points = []
+    for a, b, c in zip(points[-1:] + points[:-1], points, points[1:] + points[:1]):
+        if gm.ccw(a, b, c) * orientation > 0:
+            convex_points.append(b)
+    return convex_points
+
+
+def create_route(point_a: Point, point_b: Point, polygons_to_avoid: list, use_cache: bool = True) -> Route:
     """
     Create route from one point to another, avoiding a set of provided polygons
     Point can not be IN one of the provided polygons.
     :param point_a: Start Point
     :param point_b: End Point
     :param polygons_to_avoid: List of polygons to avoid
+    :param use_cache: Whether a cached route between nearly the same endpoints may be returned - such a route can be
+                      slightly longer than the one the planner creates
     :return:
     """
     t_0 = time.perf_counter()
     # logger.debug(f"Creating route from {point_a} to {point_b}")
     point_a = copy.deepcopy(point_a)
     point_b = copy.deepcopy(point_b)
+
+    route = route_cache.get(point_a, point_b, polygons_to_avoid) if use_cache and route_cache.size > 0 else None
+    if route is None:
+        if constants.ROUTE_PLANNER == "visibility_graph":
+            route = get_visibility_graph(polygons_to_avoid).find_path(point_a, point_b)
+        elif constants.ROUTE_PLANNER == "convex_hull":
+            route = create_convex_hull_route(point_a, point_b, polygons_to_avoid)
+        else:
+            raise NotImplementedError(f"Route planner {constants.ROUTE_PLANNER} not implemented.")
+        route_cache.put(point_a, point_b, polygons_to_avoid, route)
+
+    # logger.debug(f"Route is set to {[str(p) for p in route]}")
+    t_1 = time.perf_counter()
+    constants.time_spent_creating_routes += (t_1 - t_0)
+    return Route(points=route)
+
+
+def create_convex_hull_route(point_a: Point, point_b: Point, polygons_to_avoid: list) -> list:
+    """
+    Create route by rerouting around every crossed obstacle along its convex hull until no obstacles are crossed.
+    :param point_a: Start Point
+    :param point_b: End Point
+    :param polygons_to_avoid: List of polygons to avoid
+    :return: List of points from a to b
+    """
     route = [point_a, point_b]
 
     obstacle_on_route = True
@@ -90,20 +375,26 @@ def create_route(point_a: Point, point_b: Point, polygons_to_avoid: list) -> Rou
             raise TimeoutError(f"Unable to create route from {point_a} to {point_b} "
                                f"around {obstacle}, going through edge: {point_k}, {point_l}")
 
-    shorter_route = gm.maximize_concavity(route, polygons_to_avoid)
-    # logger.debug(f"Route is set to {[str(p) for p in shorter_route]}")
-    t_1 = time.perf_counter()
-    constants.time_spent_creating_routes += (t_1 - t_0)
-    return Route(points=shorter_route)
+    return gm.pull_path_taut(route, polygons_to_avoid)
 
 
 def line_crosses_any_polygon(polygons_to_avoid: list, route) -> (bool, Polygon, Point, Point):
-    for polygon in polygons_to_avoid:
-        for p_1, p_2 in zip(route, route[1:]):
-            violation = polygon.check_if_line_through_polygon(p_1=p_1, p_2=p_2)
-            if violation:
-                # logger.debug(f"Line from {p_1} to {p_2} crosses through polygon {[str(p) for p in polygon.points]}")
-                return True, polygon, p_1, p_2
+    if len(route) < 2 or len(polygons_to_avoid) == 0:
+        return False, 0, 0, 0
+
+    # Only the (polygon, segment) pairs of which the bounding boxes meet are checked exactly
+    coordinates = np.array([(p.x, p.y) for p in route])
+    segment_indices, polygon_indices = get_geography_index(polygons_to_avoid).query_segments(
+        coordinates[:-1, 0], coordinates[:-1, 1], coordinates[1:, 0], coordinates[1:, 1])
+
+    # Keep the order of the full scan - by polygon first, then along the route
+    for pair in np.lexsort((segment_indices, polygon_indices)):
+        polygon = polygons_to_avoid[polygon_indices[pair]]
+        p_1, p_2 = route[segment_indices[pair]], route[segment_indices[pair] + 1]
+        violation = polygon.check_if_line_through_polygon(p_1=p_1, p_2=p_2)
+        if violation:
+            # logger.debug(f"Line from {p_1} to {p_2} crosses through polygon {[str(p) for p in polygon.points]}")
+            return True, polygon, p_1, p_2
     return False, 0, 0, 0
 
 
@@ -353,13 +644,14 @@ def re_add_point_to_hull(target: Point, c_h: list, obstacle: Polygon) -> list:
     #              f"extended polypoints is {[str(p) for p in ext_polygon_points]}")
     # Find the two convex hull points adjacent to this point
     point_options = []
+    ext_polygon = Polygon(ext_polygon_points)
     for convex_point in c_h:
         if convex_point is closest_point:
             continue
         points_a_to_b = get_points_between_a_b(a=convex_point, b=closest_point,
-                                               polygon=Polygon(ext_polygon_points), inclusive=True)
+                                               polygon=ext_polygon, inclusive=True)
         points_b_to_a = get_points_between_a_b(a=closest_point, b=convex_point,
-                                               polygon=Polygon(ext_polygon_points), inclusive=True)
+                                               polygon=ext_polygon, inclusive=True)
         # logger.debug(f"Convex point {convex_point} - closest point {closest_point}")
         # logger.debug(f"a_to_b: {[str(p) for p in points_a_to_b]}, b_to_a: {[str(p) for p in points_b_to_a]}")
         point_options.append([convex_point, points_a_to_b, "precedes"])
@@ -417,6 +709,7 @@ def re_add_point_to_hull(target: Point, c_h: list, obstacle: Polygon) -> list:
 def create_convex_hull(obstacle: Polygon, points=None) -> list:
     """
     Creates convex hull of set of points and polygons.
+    The given points are forced into the hull (losing convexity if needed), neither they nor the obstacle are modified.
     :param obstacle: List of polygons, each entry in the list is a polygon
     :param points: List of points, no point, or single point
     :return:
@@ -424,16 +717,14 @@ def create_convex_hull(obstacle: Polygon, points=None) -> list:
     if points is None or len(points) == 0:
         all_points = []
     elif isinstance(points, list):
-        all_points = points
+        all_points = points.copy()
     elif isinstance(points, Point):
         all_points = [points]
         warnings.warn("create_convex_hull received a single point rather than a list of points")
     else:
         raise TypeError("Unexpected Type For List Of Points")
 
-    for point in all_points:
-        # logger.debug(f"Setting points {point} to FORCE-MAINTAIN")
-        point.force_maintain = True
+    forced_points = all_points.copy()
 
     for point in obstacle.points:
         if point not in all_points:
@@ -442,13 +733,11 @@ def create_convex_hull(obstacle: Polygon, points=None) -> list:
 
     convex_hull = gm.graham_scan(all_points)
 
-    for point in all_points:
-        if point.force_maintain and point not in convex_hull:
+    for point in forced_points:
+        if point not in convex_hull:
             convex_hull = re_add_point_to_hull(point, convex_hull, obstacle)
 
     # logger.debug(f"Returning convex hull {Polygon(convex_hull)}")
-    for point in all_points:
-        point.force_maintain = False
     return convex_hull
 
 
@@ -500,18 +789,13 @@ def create_path_along_polygon_between_points(start_point: Point, target: Point,
         obstructed = obstacle.check_if_line_through_polygon(point, target)
         if obstructed:
             path.append(point)
-            # Check if we can remove intermediate points
-            if len(path) >= 2:
-                path = gm.maximize_concavity(path, [obstacle])
 
         # if we can reach point, complete the path
         else:
             # logger.debug(f"Able to reach {target} from {point}")
             path.extend([point, target])
-            # Check if we can remove intermediate points
-            if len(path) >= 2:
-                path = gm.maximize_concavity(path, [obstacle])
-            return path
+            # Remove the intermediate points that are not needed to get around the obstacle
+            return gm.pull_path_taut(path, [obstacle])
 
     raise NotImplementedError(f"Unable to create path along polygon - {start_point=}, {target=},"
                               f" {[str(p) for p in points_to_travel_from]}")
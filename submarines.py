@@ -3,7 +3,7 @@ import constants
 import model_info
 import numpy as np
 
-from general_maths import calculate_distance
+from general_maths import calculate_distance, check_if_point_in_polygons
 from points import Point
 from base import Harbour
 
@@ -177,9 +177,7 @@ class Submarine(Agent):
             entry_point = Point(x=lamb * constants.MAX_LAT + (1 - lamb) *
                                   (0.5 * constants.MIN_LAT + 0.5 * constants.MAX_LAT),
                                 y=y)
-            in_landmass = any([landmass.check_if_contains_point(entry_point)
-                               for landmass in constants.world.landmasses])
-            if not in_landmass:
+            if not check_if_point_in_polygons(constants.world.landmasses, entry_point):
                 break
 
         self.entry_point = entry_point
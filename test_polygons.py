@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+import shapely
+import shapely.geometry
+
+# The modules log to logs/ in the working directory
+os.makedirs(os.path.join(os.getcwd(), "logs"), exist_ok=True)
+
+from points import Point
+from polygons import Polygon
+
+
+def sampled_can_connect(polygon: Polygon, p_1: Point, p_2: Point) -> bool:
+    """
+    The former, sampling version of check_if_can_connect_edge_points - none of 99 points on the line may be in
+    the polygon
+    """
+    for lamb in np.arange(0.01, 1, 0.01):
+        if polygon.check_if_contains_point(Point(p_1.x * lamb + p_2.x * (1 - lamb),
+                                                 p_1.y * lamb + p_2.y * (1 - lamb))):
+            return False
+    return True
+
+
+def random_polygon(generator: np.random.Generator) -> Polygon:
+    """
+    Random simple polygon - random points ordered by their polar angle around the lowest one
+    """
+    number_of_points = int(generator.integers(4, 12))
+    points = [Point(float(x), float(y)) for x, y in generator.uniform(0, 10, size=(number_of_points, 2))]
+    polygon = Polygon(points)
+    polygon.order_points()
+    return polygon
+
+
+def random_edge_point(polygon: Polygon, generator: np.random.Generator) -> Point:
+    index = int(generator.integers(len(polygon.points)))
+    a = polygon.points[index]
+    b = polygon.points[(index + 1) % len(polygon.points)]
+    lamb = float(generator.uniform(0, 1))
+    return Point(a.x * lamb + b.x * (1 - lamb), a.y * lamb + b.y * (1 - lamb))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_check_if_can_connect_edge_points_matches_sampling(seed):
+    generator = np.random.default_rng(seed)
+    disagreements = []
+    cases = 0
+    for _ in range(60):
+        polygon = random_polygon(generator)
+        if not polygon.geometry.is_valid:
+            continue
+
+        pairs = [(p_1, p_2) for i, p_1 in enumerate(polygon.points) for p_2 in polygon.points[i + 1:]]
+        pairs += [(random_edge_point(polygon, generator), random_edge_point(polygon, generator)) for _ in range(10)]
+        for p_1, p_2 in pairs:
+            cases += 1
+            exact = polygon.check_if_can_connect_edge_points(p_1, p_2)
+            if exact != sampled_can_connect(polygon, p_1, p_2):
+                disagreements.append((polygon, p_1, p_2, exact))
+
+    assert cases > 0
+    for polygon, p_1, p_2, exact in disagreements:
+        # The sampler can only miss incursions into the polygon - short ones that fall in between its samples,
+        # or thin ones that its edge tolerance swallows. The line has to share a stretch with the interior.
+        assert not exact, f"Line ({p_1}, {p_2}) is connectable by sampling, but not by the exact check"
+        line = shapely.geometry.LineString([(p_1.x, p_1.y), (p_2.x, p_2.y)])
+        assert shapely.relate_pattern(line, polygon.geometry, "1********")
@@ -1,16 +1,21 @@
-import pandas as pd
+import concurrent.futures
+import hashlib
+import os
+
 import numpy as np
 import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.express as px
-from perlin_noise import PerlinNoise
 
 import constants
+from geography import save_cache_file
+
+WAVE_DATA_FILE = "wave_data.nc"
+WEATHER_TRANSITION_STEPS = 3
 
 
 def fetch_weather_markov_chain(make_plots=True, steps=1) -> dict:
+    import pandas as pd
     import xarray as xr
-    df = xr.open_dataset("wave_data.nc", engine="netcdf4").to_dataframe()
+    df = xr.open_dataset(WAVE_DATA_FILE, engine="netcdf4").to_dataframe()
     """
     mwd = mean wave direction
     swh = Significant Wave Height
@@ -39,33 +44,17 @@ def fetch_weather_markov_chain(make_plots=True, steps=1) -> dict:
     df["swh_rounded_lag_steps"] = df["swh_rounded"].shift(steps)
 
     data = df[["swh_rounded", "swh_rounded_lag", "swh_rounded_lag_2", "swh_rounded_lag_steps"]].dropna()
-    data_1 = (data[["swh_rounded", "swh_rounded_lag"]].groupby(["swh_rounded", "swh_rounded_lag"])
-              .size().reset_index())
-    data_2 = (data[["swh_rounded", "swh_rounded_lag_2"]].groupby(["swh_rounded", "swh_rounded_lag_2"])
-              .size().reset_index())
-    data_steps = (data[["swh_rounded", "swh_rounded_lag_steps"]].groupby(["swh_rounded", "swh_rounded_lag_steps"])
-                  .size().reset_index())
-    data_1 = data_1.rename(columns={0: "count"})
-    data_2 = data_2.rename(columns={0: "count"})
-    data_steps = data_steps.rename(columns={0: "count"})
-
-    states = data_1["swh_rounded"].unique()
-    for state in states:
-        total_value_1 = sum(data_1[data_1["swh_rounded"] == state]["count"])
-        total_value_2 = sum(data_2[data_2["swh_rounded"] == state]["count"])
-        total_value_steps = sum(data_steps[data_steps["swh_rounded"] == state]["count"])
-        data_1.loc[data_1["swh_rounded"] == state, 'count'] = (
-                data_1[data_1["swh_rounded"] == state]["count"] / total_value_1)
-        data_2.loc[data_2["swh_rounded"] == state, 'count'] = (
-                data_2[data_2["swh_rounded"] == state]["count"] / total_value_2)
-        data_steps.loc[data_steps["swh_rounded"] == state, 'count'] = (
-                data_steps[data_steps["swh_rounded"] == state]["count"] / total_value_steps)
+    # Transition probabilities per current state (rows) to the lagged state (columns)
+    data_1 = pd.crosstab(data["swh_rounded"], data["swh_rounded_lag"], normalize="index")
+    data_steps = pd.crosstab(data["swh_rounded"], data["swh_rounded_lag_steps"], normalize="index")
+
+    states = data_1.index
 
     if make_plots:
+        import seaborn as sns
         fig = plt.figure()
-        pivot = data_1.pivot(index="swh_rounded", columns="swh_rounded_lag", values='count')
         sns.set(font_scale=0.7)
-        ax = sns.heatmap(pivot, annot=True, fmt='0.3f')
+        ax = sns.heatmap(data_1, annot=True, fmt='0.3f')
         ax.set_facecolor('white')
         ax.set_title("Sea State Transitions")
         ax.set_xlabel("Next Sea State")
@@ -73,9 +62,8 @@ def fetch_weather_markov_chain(make_plots=True, steps=1) -> dict:
         fig.show()
 
         fig_2 = plt.figure()
-        pivot = data_steps.pivot(index="swh_rounded", columns="swh_rounded_lag_steps", values='count')
         sns.set(font_scale=0.7)
-        ax_2 = sns.heatmap(pivot, annot=True, fmt='0.3f')
+        ax_2 = sns.heatmap(data_steps, annot=True, fmt='0.3f')
         ax_2.set_facecolor('white')
         ax_2.set_title(f"Sea State Transitions - {steps} steps")
         ax_2.set_xlabel(f"Next Sea State - {steps} steps")
@@ -83,35 +71,95 @@ def fetch_weather_markov_chain(make_plots=True, steps=1) -> dict:
         fig_2.show()
 
     # Creating the DTMC matrix as dictionary:
-    matrix = dict()
+    if steps == 1:
+        transitions = data_1.reindex(index=states, columns=states, fill_value=0)
+    else:
+        transitions = data_steps.reindex(index=states, columns=states, fill_value=0)
 
+    matrix = dict()
     for state_0 in states:
-        matrix[int(state_0)] = {}
-        for state_1 in states:
-            if steps == 1:
-                state_data = data_1[(data_1["swh_rounded"] == state_0) & (data_1["swh_rounded_lag"] == state_1)]
-            else:
-                state_data = data_steps[(data_steps["swh_rounded"] == state_0) &
-                                        (data_steps["swh_rounded_lag_steps"] == state_1)]
-
-            if len(state_data) == 0:
-                transition_probability = 0
-            else:
-                transition_probability = state_data['count'].item()
-            matrix[int(state_0)][int(state_1)] = transition_probability
+        matrix[int(state_0)] = {int(state_1): float(transitions.loc[state_0, state_1]) for state_1 in states}
 
     if make_plots:
+        import plotly.express as px
         fig_location = px.scatter(df, x="longitude", y="latitude", animation_frame="time", color="swh")
         fig_location.show()
 
     return matrix
 
 
-weather_transition_matrix = fetch_weather_markov_chain(make_plots=False, steps=3)
+def weather_transition_key(steps=1) -> str:
+    """
+    Cache key of the transition matrix over a number of steps. The wave data is identified by its size and
+    modification time, hashing the full file would cost every run a read of it.
+    :param steps: Number of steps between the states
+    :return:
+    """
+    status = os.stat(WAVE_DATA_FILE)
+    key = hashlib.sha1(repr((os.path.basename(WAVE_DATA_FILE), status.st_size, status.st_mtime_ns, steps)).encode())
+    return key.hexdigest()
+
+
+def load_weather_markov_chain(steps=1) -> dict:
+    """
+    Transition matrix of fetch_weather_markov_chain, cached on disk keyed by weather_transition_key
+    :param steps: Number of steps between the states
+    :return: Matrix as dictionary of dictionaries, state: {next state: probability}
+    """
+    if constants.CACHE_DIRECTORY is None:
+        return fetch_weather_markov_chain(make_plots=False, steps=steps)
 
+    cache_file = os.path.join(os.getcwd(), constants.CACHE_DIRECTORY,
+                              f"weather_transitions_{weather_transition_key(steps)}.npz")
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            states = cached["states"].tolist()
+            probabilities = cached["probabilities"].tolist()
+        return {state_0: dict(zip(states, row)) for state_0, row in zip(states, probabilities)}
 
-def update_sea_states(world):
+    matrix = fetch_weather_markov_chain(make_plots=False, steps=steps)
+    states = list(matrix.keys())
+    save_cache_file(cache_file, np.savez, states=np.array(states, dtype=int),
+                    probabilities=np.array([[matrix[state_0][state_1] for state_1 in states] for state_0 in states]))
+    return matrix
+
+
+weather_transition_matrix = None
+
+
+def get_weather_transition_matrix() -> dict:
+    """
+    Returns the weather transition matrix, loads it on first use
+    """
     global weather_transition_matrix
+    if weather_transition_matrix is None:
+        weather_transition_matrix = load_weather_markov_chain(steps=WEATHER_TRANSITION_STEPS)
+    return weather_transition_matrix
+
+
+cumulative_transitions = None
+
+
+def get_cumulative_transitions() -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Dense form of the weather transition matrix, built on first use
+    :return: Array of the states, array mapping a state to its row (-1 if not a state) and
+             the matrix of cumulative transition probabilities (row: current state, column: next state)
+    """
+    global cumulative_transitions
+    if cumulative_transitions is None:
+        matrix = get_weather_transition_matrix()
+        states = np.array(list(matrix.keys()), dtype=int)
+        state_rows = np.full(states.max() + 1, -1, dtype=int)
+        state_rows[states] = np.arange(len(states))
+        # Every row lists the probabilities to all states, in the same order
+        cumulative_probabilities = np.cumsum([[matrix[state][next_state] for next_state in states]
+                                              for state in states], axis=1)
+        cumulative_transitions = (states, state_rows, cumulative_probabilities)
+    return cumulative_transitions
+
+
+def update_sea_states(world):
     grid = world.receptor_grid
     update_u_values(grid)
 
@@ -133,36 +181,315 @@ def update_sea_states(world):
     #             break
 
     # PERLIN NOISE MODEL
-    for receptor in grid.receptors:
-        transition_probabilities = weather_transition_matrix[receptor.sea_state]
-        prob = 0
-        for key in transition_probabilities.keys():
-            prob += transition_probabilities[key]
-            if prob > receptor.new_uniform_value:
-                receptor.sea_state = key
-                break
+    transition_sea_states(grid.sea_state, grid.new_uniform_value)
 
 
-def update_u_values(grid):
-    cols = grid.max_cols
-    rows = grid.max_rows
+def transition_sea_states(sea_state: np.ndarray, uniform_values: np.ndarray) -> None:
+    """
+    Moves every cell to its next sea state, in place.
+    The next state is the first of which the cumulative probability exceeds the uniform value,
+    cells of which no cumulative probability exceeds it keep their state
+    :param sea_state: Integer array of the current sea states
+    :param uniform_values: Array of the same shape with the uniform values that pick the transitions
+    :return:
+    """
+    states, state_rows, cumulative_probabilities = get_cumulative_transitions()
+    if sea_state.min() < 0 or sea_state.max() >= len(state_rows) or (state_rows[sea_state] < 0).any():
+        raise KeyError(f"Sea states {np.unique(sea_state)} not all in the transition matrix ({states})")
+
+    exceeds = cumulative_probabilities[state_rows[sea_state]] > uniform_values[..., np.newaxis]
+    found = exceeds.any(axis=-1)
+    sea_state[found] = states[np.argmax(exceeds, axis=-1)[found]]
+
+
+def gradient_noise(rows: int, cols: int, frequency: float, generator: np.random.Generator) -> np.ndarray:
+    """
+    Perlin (gradient) noise sampled at the cells of a (rows, cols) grid spanning `frequency` noise cells
+    :param rows: Number of rows
+    :param cols: Number of columns
+    :param frequency: Number of noise cells across the grid
+    :param generator: Random generator for the gradients
+    :return: Array of shape (rows, cols) with values in about [-0.7, 0.7]
+    """
+    x = np.arange(rows) / rows * frequency
+    y = np.arange(cols) / cols * frequency
+    x_0 = np.floor(x).astype(int)
+    y_0 = np.floor(y).astype(int)
+    d_x = (x - x_0)[:, np.newaxis]
+    d_y = (y - y_0)[np.newaxis, :]
+
+    # Random unit gradient at every corner of the noise cells
+    angles = generator.uniform(0, 2 * np.pi, size=(x_0[-1] + 2, y_0[-1] + 2))
+    gradient_x = np.cos(angles)
+    gradient_y = np.sin(angles)
+
+    def corner(row_offset, col_offset):
+        rows_index = (x_0 + row_offset)[:, np.newaxis]
+        cols_index = (y_0 + col_offset)[np.newaxis, :]
+        return (gradient_x[rows_index, cols_index] * (d_x - row_offset) +
+                gradient_y[rows_index, cols_index] * (d_y - col_offset))
+
+    def fade(t):
+        return t * t * t * (t * (t * 6 - 15) + 10)
+
+    u = fade(d_x)
+    v = fade(d_y)
+    bottom = corner(0, 0) * (1 - u) + corner(1, 0) * u
+    top = corner(0, 1) * (1 - u) + corner(1, 1) * u
+    return bottom * (1 - v) + top * v
+
+
+def perlin_noise_field(rows: int, cols: int, generator: np.random.Generator, out: np.ndarray = None) -> np.ndarray:
+    """
+    Sum of WEATHER_NOISE_OCTAVES octaves of gradient noise, normalized to [0, 1]
+    :param rows: Number of rows
+    :param cols: Number of columns
+    :param generator: Random generator for the gradients
+    :param out: Array of shape (rows, cols) to write the field into
+    :return:
+    """
+    field = np.zeros((rows, cols)) if out is None else out
+    field[:] = 0
+    amplitude = 1
+    for octave in range(constants.WEATHER_NOISE_OCTAVES):
+        field += amplitude * gradient_noise(rows, cols, constants.WEATHER_NOISE_FREQUENCY * 2 ** octave, generator)
+        amplitude /= 2
+
+    field -= field.min()
+    if field.max() > 0:
+        field /= field.max()
+    return field
+
+
+noise_generator = None
+
 
+def get_noise_generator() -> np.random.Generator:
+    global noise_generator
+    if noise_generator is None:
+        noise_generator = np.random.default_rng(constants.WEATHER_NOISE_SEED)
+    return noise_generator
+
+
+noise_executor = None
+noise_prefetches = {}
+
+
+def prefetch_noise_field(rows: int, cols: int) -> None:
+    """
+    Starts computing the next noise field of a grid shape on the worker thread, if it is not already underway.
+    The noise generator is only used by the worker, so the fields come in the same order as without prefetching.
+    :param rows: Number of rows
+    :param cols: Number of columns
+    :return:
+    """
+    global noise_executor
+    if noise_executor is None:
+        noise_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    if (rows, cols) not in noise_prefetches:
+        noise_prefetches[(rows, cols)] = noise_executor.submit(perlin_noise_field, rows, cols, get_noise_generator())
+
+
+def get_next_noise_field(rows: int, cols: int) -> np.ndarray:
+    """
+    Returns the next noise field, computed during the preceding steps when WEATHER_NOISE_PREFETCH is set,
+    and starts on the one after it
+    :param rows: Number of rows
+    :param cols: Number of columns
+    :return: Array of shape (rows, cols)
+    """
+    if not constants.WEATHER_NOISE_PREFETCH:
+        return perlin_noise_field(rows, cols, get_noise_generator())
+
+    prefetch_noise_field(rows, cols)
+    field = noise_prefetches.pop((rows, cols)).result()
+    prefetch_noise_field(rows, cols)
+    return field
+
+
+def reset_noise_fields() -> None:
+    """
+    Cancels the prefetched noise fields, shuts the worker thread down and resets the noise generator, so that the
+    next World starts over from WEATHER_NOISE_SEED
+    :return:
+    """
+    global noise_executor, noise_generator
+    if noise_executor is not None:
+        noise_executor.shutdown(wait=True, cancel_futures=True)
+        noise_executor = None
+    noise_prefetches.clear()
+    noise_generator = None
+
+
+def update_u_values(grid):
     # TODO: Base octave on weather conditions (lower octave = more stable) -
     #  other option is to scale the distribution dependent on weather conditions
+    grid.last_uniform_value[:] = grid.new_uniform_value
+    grid.new_uniform_value[:] = get_next_noise_field(grid.max_rows, grid.max_cols)
+
+
+def render_weather_timeline(steps: int, rows: int, cols: int, seed=None) -> np.ndarray:
+    """
+    Renders the sea states of `steps` consecutive weather updates, as update_sea_states would produce them,
+    starting from INITIAL_SEA_STATE everywhere.
+    :param steps: Number of weather updates
+    :param rows: Number of rows of the receptor grid
+    :param cols: Number of columns of the receptor grid
+    :param seed: Seed of the noise generator
+    :return: Array of shape (steps, rows, cols), the sea states after every update
+    """
+    generator = np.random.default_rng(seed)
+    sea_state = np.full((rows, cols), constants.INITIAL_SEA_STATE, dtype=int)
+    uniform_values = np.zeros((rows, cols))
+
+    timeline = np.empty((steps, rows, cols), dtype=np.int8)
+    for step in range(steps):
+        perlin_noise_field(rows, cols, generator, out=uniform_values)
+        transition_sea_states(sea_state, uniform_values)
+        timeline[step] = sea_state
+    return timeline
+
+
+def weather_timeline_file(steps: int, rows: int, cols: int, seed) -> str:
+    """
+    Cache file of a weather timeline, keyed by a hash of everything the rendered sea states depend on.
+    The transition matrix enters through its cache key, so finding a rendered timeline does not load it.
+    """
+    key = hashlib.sha1()
+    key.update(repr((steps, rows, cols, seed, constants.INITIAL_SEA_STATE,
+                     constants.WEATHER_NOISE_FREQUENCY, constants.WEATHER_NOISE_OCTAVES,
+                     weather_transition_key(WEATHER_TRANSITION_STEPS))).encode())
+    return os.path.join(os.getcwd(), constants.CACHE_DIRECTORY, f"weather_timeline_{key.hexdigest()}.npy")
+
+
+def load_weather_timeline(steps: int, rows: int, cols: int, seed=None) -> np.ndarray:
+    """
+    Weather timeline of render_weather_timeline, memory-mapped from the cache so that every replication with
+    the same horizon and seed replays identical weather. Renders and saves the timeline if it is not cached yet.
+    :param steps: Number of weather updates
+    :param rows: Number of rows of the receptor grid
+    :param cols: Number of columns of the receptor grid
+    :param seed: Seed of the noise generator
+    :return: Read-only array of shape (steps, rows, cols)
+    """
+    if constants.CACHE_DIRECTORY is None:
+        return render_weather_timeline(steps, rows, cols, seed)
+
+    cache_file = weather_timeline_file(steps, rows, cols, seed)
+    if not os.path.exists(cache_file):
+        timeline = render_weather_timeline(steps, rows, cols, seed)
+        save_cache_file(cache_file, np.save, timeline)
+    return np.load(cache_file, mmap_mode="r")
+
+
+class ObservedWeather:
+    """
+    Sea states observed in the wave data, streamed for the simulated window.
+    The significant wave height is read a chunk of WEATHER_OBSERVED_CHUNK_SIZE time steps at a time, only at the
+    data points nearest to the receptors, and rounded to sea states. The next chunk is read by a single worker
+    thread while the current one is replayed, so at most two chunks are held in memory.
+    """
+    def __init__(self, grid, start=None):
+        """
+        :param grid: Receptor grid the wave data is regridded onto
+        :param start: Date and time in the wave data at which the simulation starts, None for the first observation
+        """
+        import xarray as xr
+
+        self.dataset = xr.open_dataset(WAVE_DATA_FILE, engine="netcdf4")
+        swh = self.dataset["swh"].transpose("time", "latitude", "longitude")
+        self.times = swh["time"].values
+        # Observations hold until the next one, the last one for as long as the one before it
+        if len(self.times) > 1:
+            self.end = self.times[-1] + (self.times[-1] - self.times[-2])
+        else:
+            self.end = self.times[-1]
+        if start is None:
+            self.start = self.times[0]
+        else:
+            self.start = np.datetime64(start)
+
+        # Nearest data point to every receptor - rows run along the longitude, columns along the latitude
+        longitudes = swh["longitude"].values
+        latitudes = swh["latitude"].values
+        receptor_x = grid.x[:, 0]
+        receptor_y = grid.y[0, :]
+        longitude_index = np.abs(receptor_x[:, np.newaxis] - longitudes[np.newaxis, :]).argmin(axis=1)
+        latitude_index = np.abs(receptor_y[:, np.newaxis] - latitudes[np.newaxis, :]).argmin(axis=1)
+        # Receptors outside the extent of the data are not extrapolated from its edge
+        self.out_of_range = ((np.abs(receptor_x - longitudes[longitude_index]) >
+                              constants.WEATHER_OBSERVED_MAX_DISTANCE)[:, np.newaxis] |
+                             (np.abs(receptor_y - latitudes[latitude_index]) >
+                              constants.WEATHER_OBSERVED_MAX_DISTANCE)[np.newaxis, :])
+
+        # Only the data points that are nearest to a receptor are read
+        self.longitudes_read, self.row_index = np.unique(longitude_index, return_inverse=True)
+        self.latitudes_read, self.col_index = np.unique(latitude_index, return_inverse=True)
+        self.swh = swh
+
+        self.chunk_size = constants.WEATHER_OBSERVED_CHUNK_SIZE
+        self.chunk_number = None
+        self.chunk = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.prefetched_number = None
+        self.prefetched_chunk = None
+
+    def read_chunk(self, chunk_number: int) -> np.ndarray:
+        """
+        Reads a chunk of the wave data and regrids it onto the receptors
+        :param chunk_number: Number of the chunk, chunk n holds time steps [n * chunk size, (n + 1) * chunk size)
+        :return: Array of shape (time steps, rows, cols) of sea states, -1 where the data has no wave height or the
+                 receptor is out of its range
+        """
+        time_steps = slice(chunk_number * self.chunk_size, (chunk_number + 1) * self.chunk_size)
+        swh = self.swh.isel(time=time_steps, latitude=self.latitudes_read, longitude=self.longitudes_read).values
+        # (time, latitude, longitude) -> (time, rows, cols)
+        swh = swh[:, self.col_index[np.newaxis, :], self.row_index[:, np.newaxis]]
+        return np.where(np.isnan(swh) | self.out_of_range, -1, np.round(swh)).astype(np.int8)
+
+    def load_chunk(self, chunk_number: int) -> None:
+        if self.prefetched_number == chunk_number:
+            self.chunk = self.prefetched_chunk.result()
+        else:
+            self.chunk = self.executor.submit(self.read_chunk, chunk_number).result()
+        self.chunk_number = chunk_number
+
+        self.prefetched_number = None
+        self.prefetched_chunk = None
+        if (chunk_number + 1) * self.chunk_size < len(self.times):
+            self.prefetched_number = chunk_number + 1
+            self.prefetched_chunk = self.executor.submit(self.read_chunk, chunk_number + 1)
+
+    def update_sea_states(self, sea_state: np.ndarray, world_time: float) -> None:
+        """
+        Sets the sea states to the last observation at or before the world time, in place.
+        Receptors without a wave height in the data (on land) or out of its range keep their sea state.
+        :param sea_state: Array of shape (rows, cols) with the sea states
+        :param world_time: Time since the start of the simulation in hours
+        :return:
+        """
+        moment = self.start + np.timedelta64(int(round(world_time * 3600)), "s")
+        index = int(np.searchsorted(self.times, moment, side="right")) - 1
+        if index < 0 or moment > self.end:
+            raise ValueError(f"No wave data at {moment}, the data covers {self.times[0]} to {self.times[-1]}")
+
+        chunk_number = index // self.chunk_size
+        if chunk_number != self.chunk_number:
+            self.load_chunk(chunk_number)
+        observed = self.chunk[index - chunk_number * self.chunk_size]
+        np.copyto(sea_state, observed, where=observed >= 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    noise = PerlinNoise(octaves=8)
-    noise_data = [[noise([j/rows, i/cols]) for i in range(cols)] for j in range(rows)]
-    # normalize noise
-    min_value = min(x if isinstance(x, int) else min(x) for x in noise_data)
-    noise_data = [[n + abs(min_value) for n in rows] for rows in noise_data]
-    max_value = max(x if isinstance(x, int) else max(x) for x in noise_data)
-    noise_data = [[n / max_value for n in rows] for rows in noise_data]
-    min(x if isinstance(x, int) else min(x) for x in noise_data)
-    max(x if isinstance(x, int) else max(x) for x in noise_data)
-    new_u_matrix = noise_data
-
-    # new_u_matrix = np.random.uniform(low=0, high=1, size=(rows, cols))
-    for index, receptor in enumerate(grid.receptors):
-
-        receptor.last_uniform_value = receptor.new_uniform_value
-        receptor.new_uniform_value = new_u_matrix[index // cols][index % cols]
+    def close(self) -> None:
+        """
+        Stops the prefetch worker and closes the wave data
+        """
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.prefetched_number = None
+        self.prefetched_chunk = None
+        self.dataset.close()
@@ -10,8 +10,6 @@ from logging.handlers import RotatingFileHandler
 import os
 import time
 
-import weather_data
-
 if not os.path.exists("logs"):
     os.makedirs("logs")
 
@@ -20,8 +18,12 @@ import numpy as np
 
 import constants
 import constants_coords
+import weather_data
 from polygons import Polygon
 from receptors import ReceptorGrid
+from routes import get_visibility_graph, route_cache
+from geography import get_geography_index, get_polygon_raster
+from distance_fields import get_distance_field
 from managers import MerchantManager, USManager, TaiwanManager, JapanManager, UAVManager, OTHManager, ChinaNavyManager
 
 date = datetime.date.today()
@@ -55,6 +57,15 @@ class World:
         self.initiate_land_masses()
         self.initiate_zones()
 
+        self.landmass_index = None
+        self.zone_index = None
+        self.zone_raster = None
+        self.zone_indices = {}
+        self.initiate_geography_index()
+
+        self.visibility_graph = None
+        self.initiate_visibility_graph()
+
         self.x_min = None
         self.x_max = None
 
@@ -66,12 +77,18 @@ class World:
         self.managers = None
         self.initiate_managers()
 
+        self.distance_fields = None
+        self.initiate_distance_fields()
+
         self.receptor_grid = None
         self.initiate_receptor_grid()
 
         # World Variable Characteristics
         self.weather = None
         self.time_last_weather_update = 0
+        self.weather_updates = 0
+        self.weather_timeline = None
+        self.initiate_weather()
         self.time_delta = time_delta  # In Hours
         # Usage of more detailed splits for instances of accuracy
         self.splits_per_step = int(np.ceil(constants.UAV_MOVEMENT_SPLITS_P_H * self.time_delta))
@@ -160,9 +177,45 @@ class World:
                               points=constants_coords.JAPAN_EEZ)
                       ]
 
+    def initiate_geography_index(self) -> None:
+        """
+        Builds the spatial indices over the landmasses and zones, used to select the polygons near a point or line,
+        and the raster of the zones, used to look up which zones a location is in.
+        """
+        self.landmass_index = get_geography_index(self.landmasses)
+        self.zone_index = get_geography_index(self.zones)
+        self.zone_raster = get_polygon_raster(self.zones)
+        # Position of the (first) zone with a name in the list of zones
+        self.zone_indices = {}
+        for index, zone in enumerate(self.zones):
+            self.zone_indices.setdefault(zone.name, index)
+
+    def initiate_visibility_graph(self) -> None:
+        """
+        Builds the visibility graph used for routing around the landmasses once, before any agent requests a route.
+        Starts with an empty route cache, so that no routes (or hit counts) carry over from an earlier World.
+        """
+        self.visibility_graph = get_visibility_graph(self.landmasses)
+        route_cache.clear()
+
     def initiate_receptor_grid(self) -> None:
         self.receptor_grid = ReceptorGrid(self.landmasses + [self.china_polygon], self)
 
+    def initiate_weather(self) -> None:
+        if constants.WEATHER_MODE == "timeline":
+            self.weather_timeline = weather_data.load_weather_timeline(constants.WEATHER_TIMELINE_STEPS,
+                                                                       self.receptor_grid.max_rows,
+                                                                       self.receptor_grid.max_cols,
+                                                                       seed=constants.WEATHER_TIMELINE_SEED)
+        elif constants.WEATHER_MODE == "observed":
+            self.weather = weather_data.ObservedWeather(self.receptor_grid, start=constants.WEATHER_OBSERVED_START)
+            self.weather.update_sea_states(self.receptor_grid.sea_state, 0)
+        elif constants.WEATHER_MODE == "simulated":
+            if constants.WEATHER_NOISE_PREFETCH:
+                weather_data.prefetch_noise_field(self.receptor_grid.max_rows, self.receptor_grid.max_cols)
+        else:
+            raise ValueError(f"Unknown weather mode {constants.WEATHER_MODE}")
+
     def initiate_managers(self) -> None:
         self.UAV_manager = UAVManager()
         self.china_navy_manager = ChinaNavyManager()
@@ -175,6 +228,13 @@ class World:
                          OTHManager()
                          ]
 
+    def initiate_distance_fields(self) -> None:
+        """
+        Builds the distance fields to the UAV bases up front, as the UAVs check their endurance every step.
+        Fields to other bases are built once they are first needed.
+        """
+        self.distance_fields = [get_distance_field(base.location, self.landmasses) for base in self.UAV_manager.bases]
+
     def plot_world(self, include_receptors=False) -> None:
         if not constants.PLOTTING_MODE and not constants.DEBUG_MODE:
             return
@@ -198,8 +258,7 @@ class World:
                 base.add_to_plot()
 
         if include_receptors:
-            for receptor in self.receptor_grid.receptors:
-                self.ax = receptor.initiate_plot(self.ax, self.receptor_grid.cmap)
+            self.ax = self.receptor_grid.initiate_plot(self.ax)
 
         plt.show()
         self.fig.canvas.draw()
@@ -210,8 +269,7 @@ class World:
 
         self.ax.set_title(f"Sea Map - time is {self.world_time: .3f}")
 
-        for receptor in self.receptor_grid.receptors:
-            receptor.update_plot(self.ax, self.receptor_grid.cmap)
+        self.receptor_grid.update_plot()
 
         self.fig.canvas.draw()
         self.fig.canvas.flush_events()
@@ -228,6 +286,11 @@ class World:
             logger.debug(f"{manager} is working...")
             manager.manage_agents()
 
+        t_0 = time.perf_counter()
+        self.receptor_grid.deposit_pheromones()
+        t_1 = time.perf_counter()
+        constants.time_spreading_pheromones += (t_1 - t_0)
+
         t_0 = time.perf_counter()
         self.receptor_grid.depreciate_pheromones()
         t_1 = time.perf_counter()
@@ -248,16 +311,47 @@ class World:
         if self.world_time - self.time_last_weather_update > constants.WEATHER_RESAMPLING_TIME_SPLIT:
             print(f"UPDATING SEA STATES")
             self.time_last_weather_update = self.world_time
-            weather_data.update_sea_states(self)
+            if constants.WEATHER_MODE == "timeline":
+                self.replay_weather_timeline()
+            elif constants.WEATHER_MODE == "observed":
+                self.weather.update_sea_states(self.receptor_grid.sea_state, self.world_time)
+            else:
+                weather_data.update_sea_states(self)
+            self.weather_updates += 1
             return
 
+    def close(self) -> None:
+        """
+        Releases the weather data - the observed wave data and its prefetch worker, the mapped timeline, and the
+        prefetched noise fields and their worker.
+        :return:
+        """
+        if self.weather is not None:
+            self.weather.close()
+            self.weather = None
+        self.weather_timeline = None
+        weather_data.reset_noise_fields()
+
+    def replay_weather_timeline(self) -> None:
+        """
+        Sets the sea states to the next update of the weather timeline.
+        :return:
+        """
+        if self.weather_updates >= len(self.weather_timeline):
+            raise ValueError(f"Weather timeline of {len(self.weather_timeline)} updates is exhausted, "
+                             f"increase WEATHER_TIMELINE_STEPS")
+        self.receptor_grid.sea_state[:] = self.weather_timeline[self.weather_updates]
+
 
 if __name__ == "__main__":
     t_0 = time.perf_counter()
     world = World(time_delta=0.2)
 
-    for z in range(10000):
-        world.time_step()
+    try:
+        for z in range(10000):
+            world.time_step()
+    finally:
+        world.close()
 
     t_1 = time.perf_counter()
 
@@ -277,3 +371,5 @@ if __name__ == "__main__":
           f"Following Routes: {constants.time_spent_following_route / 60} \n"
           f"Launching Drones: {constants.time_spent_launching_drones / 60} \n"
           f"Observing Area: {constants.time_spent_observing_area / 60} \n")
+    print(f"Route cache: {route_cache.hits} hits, {route_cache.misses} misses "
+          f"(hit rate {route_cache.hit_rate():.1%}, {len(route_cache)} routes stored)")